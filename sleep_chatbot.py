@@ -1,15 +1,40 @@
 # app.py - Sleep Hygiene Dashboard with Chatbot (Fixed Version)
 import dash
-from dash import dcc, html, Input, Output, State, callback, no_update
+import flask
+from dash import dcc, html, Input, Output, State, callback, clientside_callback, no_update
+from dash.fingerprint import check_fingerprint
 import dash_bootstrap_components as dbc
 import plotly.express as px
+import plotly.graph_objects as go
 import pandas as pd
+import numpy as np
 import mysql.connector
 from werkzeug.security import generate_password_hash, check_password_hash
 import dash_daq as daq
-from datetime import datetime
+from datetime import date, datetime, timedelta
 import random
+import math
 import json
+import csv
+import threading
+import time
+import gzip
+import os
+import re
+import sys
+import cProfile
+import itertools
+import multiprocessing
+import asyncio
+import contextvars
+import functools
+import hashlib
+import hmac
+import secrets
+import statistics
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter, OrderedDict, defaultdict
 
 # =============================================
 # DATABASE CONFIGURATION
@@ -19,12 +44,170 @@ dbUser = "root"
 dbPassword = ""  # Add your MySQL password if set
 dbName = "sleep_hygiene"
 
+# Read replicas: connection overrides merged over the settings above, e.g.
+# [{"host": "replica-1"}] or, for two local stand-ins, [{"port": 3307}]
+readReplicas = []
+readYourWritesSeconds = 10   # After a user's write, their reads stay on the primary this long
+replicaRetrySeconds = 30     # An unreachable replica is skipped for this long
+
+# =============================================
+# PERSONAL BASELINE CONFIGURATION
+# =============================================
+targetSleepHours = 8.0   # Nightly need used to accumulate sleep debt
+streakMinHours = 7.0     # Nights at or above this extend the good-sleep streak
+baselineMinRecords = 3   # Entries needed before comparing against the user's history
+
+# =============================================
+# SUBMISSION HANDLING CONFIGURATION
+# =============================================
+onePerNightUpsert = False     # Replace the night's entry instead of adding another row
+nightRolloverHour = 12        # Entries before this hour belong to the previous night
+duplicateSubmitWindow = 30    # Seconds a finished submission is remembered for dedup
+
+# =============================================
+# PARTITIONING & RETENTION CONFIGURATION
+# =============================================
+partitionLookaheadMonths = 3   # Empty monthly partitions kept ahead of today
+retentionMonths = 12           # Months kept in MySQL before archiving
+archiveDir = "./archive"       # Archived partitions are written here as gzip JSON lines
+partitionMaintenanceHours = 24
+
+# =============================================
+# COHORT ANALYTICS CONFIGURATION
+# =============================================
+# Admins (users.is_admin) are granted out of band: python sleep_chatbot.py grant-admin <username>
+reservedUsernames = {"admin", "administrator", "root", "support"}  # Can't be registered (case-insensitive)
+cohortPercentiles = [10, 25, 50, 75, 90]
+
+# =============================================
+# CHART CONFIGURATION
+# =============================================
+historyRecordLimit = 365   # Records loaded for the history and trends charts
+chartPixelsPerPoint = 4    # Downsample so each plotted point gets about this many pixels
+chartMinPoints = 50        # Never downsample below this many points
+
+# =============================================
+# CONVERSATION SEARCH CONFIGURATION
+# =============================================
+searchPageSize = 5
+searchSnippetChars = 160
+searchStatsSeconds = 300     # Document counts and term frequencies are reused this long
+searchStatsEntries = 10000   # Cached (scope, term) statistics kept at most
+
+# =============================================
+# BATCH RECOMMENDATION CONFIGURATION
+# =============================================
+recommendationHour = 3             # Local hour the nightly batch runs
+recommendationWindowDays = 90      # History considered per user
+recommendationMinRecords = 5       # Users with fewer entries are skipped
+recommendationProcesses = None     # Pool size (None = CPU count)
+
+# =============================================
+# RESPONSE COMPRESSION CONFIGURATION
+# =============================================
+compressMinBytes = 1024          # Smaller responses are sent as-is
+compressLevel = 6
+compressCacheEntries = 256       # Compressed static bodies kept in memory at most
+staticCacheSeconds = 31536000    # Fingerprinted bundle URLs change with their content, so they can be cached for a year
+
+# Brotli is used when the optional brotli package is installed, gzip otherwise
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# =============================================
+# PROFILING CONFIGURATION
+# =============================================
+# Read from the environment so a running deployment can be profiled by
+# sending the token, without editing code
+profileHeader = "X-Profile-Token"                     # Requests sending profileToken in this header are profiled
+profileToken = os.environ.get("PROFILE_TOKEN", "")    # Empty disables header-triggered profiling
+profileSampleRate = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))  # Fraction of callback requests profiled at random
+profileInterval = 0.005           # Seconds between stack samples
+profileDir = "./profiles"
+
+# =============================================
+# BACKGROUND CALLBACK CONFIGURATION
+# =============================================
+# Off by default: DiskcacheManager runs every job in a freshly forked
+# process, so the chart read's request coalescing and the session data cache
+# are filled in a child that exits, and each refresh re-queries MySQL and
+# forks the server. Turn it on only if cancellable charts matter more.
+backgroundCharts = False              # Run chart callbacks as background jobs when diskcache is installed
+backgroundCacheDir = "./callback-cache"
+backgroundCacheExpire = 600           # Seconds a finished chart job stays cached
+
+# Background jobs need the optional diskcache extra (pip install "dash[diskcache]")
+try:
+    import diskcache
+except ImportError:
+    diskcache = None
+
+# Without cache_by Dash deletes each result once it is read; keying on the
+# launch also drops figures cached by an older version of the code
+background_cache_launch = secrets.token_hex(8)
+
+if backgroundCharts and diskcache is not None:
+    background_callback_manager = dash.DiskcacheManager(
+        diskcache.Cache(backgroundCacheDir),
+        cache_by=[lambda: background_cache_launch],
+        expire=backgroundCacheExpire
+    )
+else:
+    background_callback_manager = None
+
+# =============================================
+# ASYNC EXECUTION CONFIGURATION
+# =============================================
+# Only useful under an ASGI server: under Flask/WSGI (app.run, sync gunicorn
+# workers) each request thread still blocks while its coroutine runs
+asyncCallbacks = False   # Serve I/O-bound callbacks as async callbacks (pip install "dash[async]")
+dbPoolSize = 32          # Threads that run blocking MySQL calls for async callbacks
+syncWorkerThreads = 8    # Request threads of a threaded WSGI worker, as modelled by the execution-mode benchmark
+
+try:
+    import asgiref
+except ImportError:
+    asgiref = None
+
+use_async_callbacks = asyncCallbacks and asgiref is not None
+
+# =============================================
+# SESSION CONFIGURATION
+# =============================================
+sessionSecret = os.environ.get("SESSION_SECRET", "")  # Signs session tokens; required with sessionDir
+sessionMaxEntries = 10000     # Sessions kept in memory; least recently used are evicted first
+sessionIdleSeconds = 12 * 3600
+sessionCacheRows = 500000     # Cached per-user data shared by all sessions, counted in rows (LRU)
+sessionDir = None             # e.g. "./sessions" to keep logins across restarts (needs diskcache)
+
+# =============================================
+# DEVICE INGESTION CONFIGURATION
+# =============================================
+# Devices drop per-minute samples as .csv or .jsonl files (written elsewhere,
+# then renamed in), in time order per user; a night may span several files
+ingestSpoolDir = "./spool"
+ingestPollSeconds = 60
+ingestBatchSize = 500          # Nights written per transaction
+deviceSleepMovement = 20       # Movement counts per minute at or below this are scored as asleep
+deviceWakeMinutes = 5          # Consecutive awake minutes after falling asleep that count as a disturbance
+deviceNoiseDb = 50             # Minutes at or above this are noisy
+deviceLightLux = 10            # Minutes at or above this are lit
+deviceExposureMinutes = 15     # Noisy/lit minutes in a night that set noise_level/light_exposure to 'yes'
+deviceMinNightMinutes = 180    # Shorter nights are dropped as incomplete
+deviceLateHours = 6            # A night stays open for samples this long after it ends
+deviceDefaultTemperature = 21.0  # Used when samples carry no temperature
+deviceSubmissionId = "device"  # Marks device entries; one per user and night
+
 # =============================================
 # APP INITIALIZATION
 # =============================================
 app = dash.Dash(__name__, 
                external_stylesheets=[dbc.themes.FLATLY],
-               suppress_callback_exceptions=True)
+               suppress_callback_exceptions=True,
+               background_callback_manager=background_callback_manager,
+               use_async=use_async_callbacks)
 app.title = "Sleep Hygiene Dashboard"
 server = app.server
 
@@ -156,6 +339,227 @@ sleep_advice = {
     }
 }
 
+# =============================================
+# SLEEP RECORD STORAGE FORMAT
+# =============================================
+# Rows are stored compactly: fixed-point hours/temperature, byte-sized counts
+# and score, and light/noise packed into one bitfield. The helpers below keep
+# the rest of the app working with the familiar 'yes'/'no' dictionaries.
+LIGHT_FLAG = 0x01
+NOISE_FLAG = 0x02
+
+# The table is range-partitioned by month on sleep_date (see PARTITION
+# MANAGEMENT), so every unique key includes it. night_slot is 1 for entries
+# written in one-per-night mode and NULL otherwise, which limits uniqueness of
+# a night to upserted entries.
+SLEEP_RECORDS_DDL = """
+        CREATE TABLE IF NOT EXISTS {table} (
+            id INT AUTO_INCREMENT,
+            user_id INT NOT NULL,
+            sleep_hours DECIMAL(3,1) NOT NULL,
+            disturbances TINYINT UNSIGNED NOT NULL,
+            temperature DECIMAL(3,1) NOT NULL,
+            env_flags TINYINT UNSIGNED NOT NULL DEFAULT 0,
+            sleep_score TINYINT UNSIGNED NOT NULL,
+            record_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sleep_date DATE NOT NULL,
+            night_slot TINYINT UNSIGNED NULL,
+            submission_id VARCHAR(64) NULL,
+            PRIMARY KEY (id, sleep_date),
+            KEY idx_user_date (user_id, record_date),
+            UNIQUE KEY uq_user_night (user_id, sleep_date, night_slot),
+            UNIQUE KEY uq_user_submission (user_id, submission_id, sleep_date)
+        ) ENGINE=InnoDB
+        {partitions}
+        """
+
+def encode_sleep_record(data, score):
+    """Convert an app-level sleep entry into compact column values"""
+    flags = 0
+    if data['light_exposure'] == 'yes':
+        flags |= LIGHT_FLAG
+    if data['noise_level'] == 'yes':
+        flags |= NOISE_FLAG
+    return (
+        round(float(data['sleep_hours']), 1),
+        min(max(int(data['disturbances']), 0), 255),
+        round(float(data['temperature']), 1),
+        flags,
+        min(max(int(score), 0), 100)
+    )
+
+def decode_sleep_record(row):
+    """Expand a compact sleep_records row back into the app-level dictionary"""
+    record = dict(row)
+    record.pop('submission_id', None)
+    record.pop('night_slot', None)
+    flags = record.pop('env_flags', 0) or 0
+    record['sleep_hours'] = float(record['sleep_hours'])
+    record['temperature'] = float(record['temperature'])
+    record['light_exposure'] = 'yes' if flags & LIGHT_FLAG else 'no'
+    record['noise_level'] = 'yes' if flags & NOISE_FLAG else 'no'
+    return record
+
+# =============================================
+# PARTITION MANAGEMENT
+# =============================================
+# Large tables are range-partitioned by month. Partition pYYYYMM holds that
+# month; p_future catches anything past the last monthly partition and is
+# split as time moves on. Foreign keys are not supported on partitioned
+# InnoDB tables, so these tables reference users(id) without one and
+# delete_user removes their rows explicitly.
+PARTITIONED_TABLES = {
+    'sleep_records': {
+        'scheme': "RANGE COLUMNS(sleep_date)",
+        'bound': "'{day}'"
+    },
+    'chatbot_conversations': {
+        'scheme': "RANGE (UNIX_TIMESTAMP(timestamp))",
+        'bound': "UNIX_TIMESTAMP('{day} 00:00:00')"
+    }
+}
+
+def month_start(day, offset=0):
+    """First day of the month offset months away from day's month"""
+    index = day.year * 12 + day.month - 1 + offset
+    return date(index // 12, index % 12 + 1, 1)
+
+def month_partition_definitions(table, months):
+    bound = PARTITIONED_TABLES[table]['bound']
+    definitions = [
+        f"PARTITION p{month:%Y%m} VALUES LESS THAN ({bound.format(day=month_start(month, 1))})"
+        for month in months
+    ]
+    definitions.append("PARTITION p_future VALUES LESS THAN (MAXVALUE)")
+    return ",\n            ".join(definitions)
+
+def month_partition_clause(table, first_month=None):
+    """PARTITION BY clause covering first_month through the lookahead window"""
+    first_month = month_start(first_month or date.today())
+    last_month = month_start(date.today(), partitionLookaheadMonths)
+    months = []
+    while first_month <= last_month:
+        months.append(first_month)
+        first_month = month_start(first_month, 1)
+    return (f"PARTITION BY {PARTITIONED_TABLES[table]['scheme']} (\n            "
+            f"{month_partition_definitions(table, months)}\n        )")
+
+def get_month_partitions(cursor, table):
+    """Existing monthly partitions of table, oldest first, as (name, month)"""
+    cursor.execute("""
+        SELECT partition_name FROM information_schema.partitions
+        WHERE table_schema = %s AND table_name = %s AND partition_name IS NOT NULL
+    """, (dbName, table))
+    partitions = []
+    for (name,) in cursor.fetchall():
+        match = re.fullmatch(r"p(\d{4})(\d{2})", name)
+        if match:
+            partitions.append((name, date(int(match.group(1)), int(match.group(2)), 1)))
+    return sorted(partitions, key=lambda item: item[1])
+
+def unpartitioned_tables(cursor):
+    """Tables in PARTITIONED_TABLES that were created before partitioning, with a warning"""
+    tables = [table for table in PARTITIONED_TABLES if not get_month_partitions(cursor, table)]
+    for table in tables:
+        print(f"⚠️ {table} is not partitioned, so it is never archived; "
+              f"run 'python sleep_chatbot.py migrate'")
+    return tables
+
+def ensure_month_partitions(cursor, table):
+    """Split p_future so monthly partitions exist through the lookahead window"""
+    partitions = get_month_partitions(cursor, table)
+    if not partitions:
+        return []
+    
+    last_month = month_start(date.today(), partitionLookaheadMonths)
+    month = month_start(partitions[-1][1], 1)
+    new_months = []
+    while month <= last_month:
+        new_months.append(month)
+        month = month_start(month, 1)
+    if new_months:
+        cursor.execute(f"""
+            ALTER TABLE {table} REORGANIZE PARTITION p_future INTO (
+            {month_partition_definitions(table, new_months)}
+            )
+        """)
+    return new_months
+
+def archive_partition(conn, table, partition_name):
+    """Stream one partition to a gzip JSON-lines file, then drop it"""
+    table_dir = os.path.join(archiveDir, table)
+    os.makedirs(table_dir, exist_ok=True)
+    path = os.path.join(table_dir, f"{table}_{partition_name[1:]}.jsonl.gz")
+    
+    rows_written = 0
+    cursor = conn.cursor(dictionary=True)
+    cursor.execute(f"SELECT * FROM {table} PARTITION ({partition_name})")
+    # Write to a temporary name so a crash never leaves a truncated archive behind
+    temp_path = f"{path}.{os.getpid()}.part"
+    with gzip.open(temp_path, 'wt', encoding='utf-8') as archive:
+        while True:
+            rows = cursor.fetchmany(1000)
+            if not rows:
+                break
+            for row in rows:
+                archive.write(json.dumps(row, default=str) + "\n")
+            rows_written += len(rows)
+    os.replace(temp_path, path)
+    
+    cursor.execute(f"ALTER TABLE {table} DROP PARTITION {partition_name}")
+    return path, rows_written
+
+def run_partition_maintenance(retention_months=None):
+    """Add upcoming monthly partitions and archive/drop the expired ones"""
+    retention_months = retentionMonths if retention_months is None else retention_months
+    cutoff = month_start(date.today(), -retention_months)
+    archived = []
+    try:
+        conn = get_db_connection()
+        if not acquire_job_lock(conn, "partition-maintenance"):
+            print("⚠️ Partition maintenance already running in another process")
+            return archived
+        cursor = conn.cursor()
+        skipped = unpartitioned_tables(cursor)
+        for table in PARTITIONED_TABLES:
+            if table in skipped:
+                continue
+            ensure_month_partitions(cursor, table)
+            partitions = get_month_partitions(cursor, table)
+            # Always keep the newest monthly partition so p_future is never the only one
+            for name, month in partitions[:-1]:
+                if month >= cutoff:
+                    break
+                path, rows = archive_partition(conn, table, name)
+                archived.append(path)
+                print(f"✅ Archived {rows} rows from {table}.{name} to {path}")
+                if table == 'chatbot_conversations':
+                    # Archived conversations leave the search index too
+                    cursor.execute("DELETE FROM chat_search_terms WHERE conversation_time < %s",
+                                   (month_start(month, 1),))
+                    conn.commit()
+        return archived
+    except (mysql.connector.Error, OSError) as err:
+        print(f"❌ Partition maintenance error: {err}")
+        return archived
+    finally:
+        if 'conn' in locals() and conn.is_connected():
+            conn.close()
+
+def start_partition_maintenance():
+    """Run partition maintenance now and then every partitionMaintenanceHours"""
+    def loop():
+        while True:
+            try:
+                run_partition_maintenance()
+            except Exception as err:  # A failed run must not stop the schedule
+                print(f"❌ Partition maintenance failed: {err}")
+            time.sleep(partitionMaintenanceHours * 3600)
+    
+    thread = threading.Thread(target=loop, name="partition-maintenance", daemon=True)
+    thread.start()
+    return thread
+
 # =============================================
 # DATABASE FUNCTIONS
 # =============================================
@@ -167,6 +571,65 @@ def get_db_connection():
         database=dbName
     )
 
+def acquire_job_lock(conn, name):
+    """Take a MySQL advisory lock for a background job on conn, released when conn closes.
+    
+    Returns False when another process (a second worker or the debug
+    reloader's twin) already runs the job.
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT GET_LOCK(%s, 0)", (f"{dbName}.{name}",))
+    return cursor.fetchone()[0] == 1
+
+# Read/write routing state (per process). recent_writes only covers writes
+# made by this process; client_last_write carries the calling client's last
+# write time (its 'last-write' store), so a read served by another worker
+# still goes to the primary.
+client_last_write = contextvars.ContextVar('client_last_write', default=None)
+recent_writes = {}
+replica_down_until = {}
+routing_lock = threading.Lock()
+replica_cycle = itertools.count()
+
+def mark_recent_write(key):
+    """Pin reads for key (a user id or username) to the primary for a while"""
+    with routing_lock:
+        now = time.monotonic()
+        recent_writes[key] = now
+        if len(recent_writes) > 10000:
+            for old_key in [k for k, t in recent_writes.items() if now - t >= readYourWritesSeconds]:
+                del recent_writes[old_key]
+
+def wrote_recently():
+    """Whether the calling client wrote within readYourWritesSeconds (on any worker)"""
+    written_at = client_last_write.get()
+    return written_at is not None and time.time() - written_at < readYourWritesSeconds
+
+def get_read_connection(key=None):
+    """Connection for read-only queries: a healthy replica unless key or the client wrote recently"""
+    if not readReplicas:
+        return get_db_connection()
+    
+    now = time.monotonic()
+    with routing_lock:
+        wrote_at = recent_writes.get(key) if key is not None else None
+    if (wrote_at is not None and now - wrote_at < readYourWritesSeconds) or wrote_recently():
+        return get_db_connection()
+    
+    start = next(replica_cycle)
+    for offset in range(len(readReplicas)):
+        index = (start + offset) % len(readReplicas)
+        if replica_down_until.get(index, 0) > now:
+            continue
+        settings = dict(host=hostName, user=dbUser, password=dbPassword, database=dbName)
+        settings.update(readReplicas[index])
+        try:
+            return mysql.connector.connect(**settings)
+        except mysql.connector.Error as err:
+            print(f"⚠️ Read replica {index} unavailable, using fallback: {err}")
+            replica_down_until[index] = now + replicaRetrySeconds
+    return get_db_connection()
+
 def setup_db():
     try:
         # Connect without specifying database first
@@ -177,53 +640,146 @@ def setup_db():
         )
         cursor = conn.cursor()
         
-        # Drop database if exists (to start fresh)
-        cursor.execute(f"DROP DATABASE IF EXISTS {dbName}")
-        
-        # Create database
-        cursor.execute(f"CREATE DATABASE {dbName}")
+        # Create database (existing data is kept; every statement is idempotent)
+        cursor.execute(f"CREATE DATABASE IF NOT EXISTS {dbName}")
         cursor.execute(f"USE {dbName}")
         
         # Create users table
         cursor.execute("""
-        CREATE TABLE users (
+        CREATE TABLE IF NOT EXISTS users (
             id INT AUTO_INCREMENT PRIMARY KEY,
             username VARCHAR(255) UNIQUE NOT NULL,
             password VARCHAR(255) NOT NULL,
             email VARCHAR(255),
+            is_admin BOOLEAN NOT NULL DEFAULT FALSE,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         ) ENGINE=InnoDB
         """)
         
-        # Create sleep_records table with proper foreign key
+        # Installs created before admin roles existed get the flag added
         cursor.execute("""
-        CREATE TABLE sleep_records (
-            id INT AUTO_INCREMENT PRIMARY KEY,
+            SELECT COUNT(*) FROM information_schema.columns
+            WHERE table_schema = %s AND table_name = 'users' AND column_name = 'is_admin'
+        """, (dbName,))
+        if not cursor.fetchone()[0]:
+            cursor.execute("ALTER TABLE users ADD COLUMN is_admin BOOLEAN NOT NULL DEFAULT FALSE AFTER email")
+        
+        # Create sleep_records table, partitioned by month
+        cursor.execute(SLEEP_RECORDS_DDL.format(
+            table="sleep_records",
+            partitions=month_partition_clause("sleep_records")
+        ))
+        
+        # Create per-user baseline statistics table (updated incrementally)
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_sleep_stats (
+            user_id INT PRIMARY KEY,
+            record_count INT NOT NULL DEFAULT 0,
+            mean_hours DOUBLE NOT NULL DEFAULT 0,
+            m2_hours DOUBLE NOT NULL DEFAULT 0,
+            mean_score DOUBLE NOT NULL DEFAULT 0,
+            m2_score DOUBLE NOT NULL DEFAULT 0,
+            mean_disturbances DOUBLE NOT NULL DEFAULT 0,
+            m2_disturbances DOUBLE NOT NULL DEFAULT 0,
+            current_streak INT NOT NULL DEFAULT 0,
+            best_streak INT NOT NULL DEFAULT 0,
+            sleep_debt DOUBLE NOT NULL DEFAULT 0,
+            last_night DATE NULL,
+            prev_streak INT NOT NULL DEFAULT 0,
+            prev_best_streak INT NOT NULL DEFAULT 0,
+            prev_sleep_debt DOUBLE NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        ) ENGINE=InnoDB
+        """)
+        
+        # Installs created before per-night streaks get the night columns added
+        cursor.execute("""
+            SELECT COUNT(*) FROM information_schema.columns
+            WHERE table_schema = %s AND table_name = 'user_sleep_stats' AND column_name = 'last_night'
+        """, (dbName,))
+        if not cursor.fetchone()[0]:
+            cursor.execute("""
+                ALTER TABLE user_sleep_stats
+                ADD COLUMN last_night DATE NULL AFTER sleep_debt,
+                ADD COLUMN prev_streak INT NOT NULL DEFAULT 0 AFTER last_night,
+                ADD COLUMN prev_best_streak INT NOT NULL DEFAULT 0 AFTER prev_streak,
+                ADD COLUMN prev_sleep_debt DOUBLE NOT NULL DEFAULT 0 AFTER prev_best_streak
+            """)
+        
+        # Create nightly precomputed recommendations table
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS precomputed_recommendations (
+            user_id INT PRIMARY KEY,
+            record_count INT NOT NULL,
+            trend_direction VARCHAR(10) NOT NULL,
+            trend_per_week DOUBLE NOT NULL,
+            dominant_factor VARCHAR(20),
+            weekday_avg_score DOUBLE,
+            weekend_avg_score DOUBLE,
+            recommendations TEXT NOT NULL,
+            computed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+        ) ENGINE=InnoDB
+        """)
+        
+        # Create conversation search index (FULLTEXT is unavailable on the
+        # partitioned chatbot_conversations table, so terms are indexed here)
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS chat_search_terms (
             user_id INT NOT NULL,
-            sleep_hours FLOAT NOT NULL,
-            disturbances INT NOT NULL,
-            temperature FLOAT NOT NULL,
-            light_exposure VARCHAR(10) NOT NULL,
-            noise_level VARCHAR(10) NOT NULL,
-            sleep_score INT NOT NULL,
-            record_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            term VARCHAR(32) NOT NULL,
+            conversation_id INT NOT NULL,
+            conversation_time TIMESTAMP NOT NULL,
+            tf SMALLINT UNSIGNED NOT NULL,
+            PRIMARY KEY (user_id, term, conversation_id),
+            KEY idx_term (term),
+            KEY idx_conversation_time (conversation_time)
+        ) ENGINE=InnoDB
+        """)
+        
+        # Create device ingestion state (one row per device user: the night
+        # being accumulated, or the last one closed, so later files continue it)
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS device_open_nights (
+            user_id INT PRIMARY KEY,
+            sleep_date DATE NOT NULL,
+            closed BOOLEAN NOT NULL DEFAULT FALSE,
+            state TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            KEY idx_open_date (closed, sleep_date),
             FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
         ) ENGINE=InnoDB
         """)
         
-        # Create chatbot_conversations table
+        # Create population histogram table (one row per day, metric and bin)
         cursor.execute("""
+        CREATE TABLE IF NOT EXISTS cohort_histograms (
+            bucket_date DATE NOT NULL,
+            metric VARCHAR(16) NOT NULL,
+            bin SMALLINT NOT NULL,
+            count INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (bucket_date, metric, bin)
+        ) ENGINE=InnoDB
+        """)
+        
+        # Create chatbot_conversations table, partitioned by month
+        cursor.execute(f"""
         CREATE TABLE IF NOT EXISTS chatbot_conversations (
-            id INT AUTO_INCREMENT PRIMARY KEY,
+            id INT AUTO_INCREMENT,
             user_id INT NOT NULL,
             message TEXT NOT NULL,
             response TEXT NOT NULL,
             timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+            PRIMARY KEY (id, timestamp),
+            KEY idx_user_time (user_id, timestamp)
         ) ENGINE=InnoDB
+        {month_partition_clause("chatbot_conversations")}
         """)
         
         conn.commit()
+        # CREATE TABLE IF NOT EXISTS leaves tables from older installs as they were
+        unpartitioned_tables(cursor)
         print("✅ Database setup completed successfully")
         
     except mysql.connector.Error as err:
@@ -232,8 +788,126 @@ def setup_db():
         if 'conn' in locals() and conn.is_connected():
             conn.close()
 
-# Initialize database
-setup_db()
+def migrate_sleep_records_compact(batch_size=5000):
+    """Move a legacy VARCHAR/FLOAT sleep_records table to the compact layout.
+    
+    Rows are copied in primary-key batches so the app keeps writing while the
+    copy runs; only the final catch-up and table swap hold a write lock.
+    """
+    copy_sql = """
+        INSERT INTO sleep_records_compact
+        (id, user_id, sleep_hours, disturbances, temperature,
+         env_flags, sleep_score, record_date, sleep_date)
+        SELECT id, user_id, ROUND(sleep_hours, 1), LEAST(GREATEST(disturbances, 0), 255),
+               ROUND(temperature, 1),
+               (light_exposure = 'yes') | ((noise_level = 'yes') << 1),
+               LEAST(GREATEST(sleep_score, 0), 100), record_date,
+               DATE(record_date - INTERVAL %s HOUR)
+        FROM sleep_records
+        WHERE id > %s AND id <= %s
+    """
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        
+        cursor.execute("""
+            SELECT COUNT(*) FROM information_schema.columns
+            WHERE table_schema = %s AND table_name = 'sleep_records'
+            AND column_name = 'light_exposure'
+        """, (dbName,))
+        if not cursor.fetchone()[0]:
+            print("✅ sleep_records already uses the compact layout")
+            return True
+        
+        cursor.execute("DROP TABLE IF EXISTS sleep_records_compact")
+        cursor.execute("SELECT MIN(record_date) FROM sleep_records")
+        oldest = cursor.fetchone()[0]
+        cursor.execute(SLEEP_RECORDS_DDL.format(
+            table="sleep_records_compact",
+            partitions=month_partition_clause("sleep_records", oldest.date() if oldest else None)
+        ))
+        
+        # Online phase: copy committed rows batch by batch
+        copied_to = 0
+        while True:
+            cursor.execute("SELECT COALESCE(MAX(id), 0) FROM sleep_records")
+            max_id = cursor.fetchone()[0]
+            if copied_to >= max_id:
+                break
+            upper = min(copied_to + batch_size, max_id)
+            cursor.execute(copy_sql, (nightRolloverHour, copied_to, upper))
+            conn.commit()
+            copied_to = upper
+        
+        # Cut-over: copy rows written during the online phase, then swap tables
+        cursor.execute("LOCK TABLES sleep_records WRITE, sleep_records_compact WRITE")
+        cursor.execute(copy_sql, (nightRolloverHour, copied_to, 2 ** 31 - 1))
+        conn.commit()
+        cursor.execute("""
+            RENAME TABLE sleep_records TO sleep_records_legacy,
+                         sleep_records_compact TO sleep_records
+        """)
+        cursor.execute("UNLOCK TABLES")
+        print("✅ sleep_records migrated to compact layout (old data kept in sleep_records_legacy)")
+        
+        # Legacy rows never went through the incremental baseline and cohort
+        # updates, so derive both from the migrated table
+        cursor.execute("DELETE FROM cohort_histograms")
+        add_records_to_cohort(cursor)
+        conn.commit()
+        rebuild_user_stats()
+        return True
+    except mysql.connector.Error as err:
+        print(f"❌ Error migrating sleep records: {err}")
+        return False
+    finally:
+        if 'conn' in locals() and conn.is_connected():
+            conn.close()
+
+def migrate_conversations_partitioned():
+    """Partition a chatbot_conversations table created before partitioning.
+    
+    Partitioned tables cannot have foreign keys and every unique key must
+    include the partitioning column, so the user foreign key is dropped and
+    the primary key becomes (id, timestamp) first. The ALTER copies the
+    table; chat saves wait until it finishes.
+    """
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        if get_month_partitions(cursor, "chatbot_conversations"):
+            print("✅ chatbot_conversations is already partitioned")
+            return True
+        
+        cursor.execute("""
+            SELECT constraint_name FROM information_schema.referential_constraints
+            WHERE constraint_schema = %s AND table_name = 'chatbot_conversations'
+        """, (dbName,))
+        for (constraint,) in cursor.fetchall():
+            cursor.execute(f"ALTER TABLE chatbot_conversations DROP FOREIGN KEY {constraint}")
+        
+        cursor.execute("UPDATE chatbot_conversations SET timestamp = CURRENT_TIMESTAMP WHERE timestamp IS NULL")
+        conn.commit()
+        cursor.execute("""
+            ALTER TABLE chatbot_conversations
+            DROP PRIMARY KEY,
+            ADD PRIMARY KEY (id, timestamp),
+            ADD KEY idx_user_time (user_id, timestamp)
+        """)
+        cursor.execute("SELECT MIN(timestamp) FROM chatbot_conversations")
+        oldest = cursor.fetchone()[0]
+        cursor.execute(f"""
+            ALTER TABLE chatbot_conversations
+            {month_partition_clause("chatbot_conversations", oldest.date() if oldest else None)}
+        """)
+        print("✅ chatbot_conversations partitioned by month")
+        return True
+    except mysql.connector.Error as err:
+        print(f"❌ Error partitioning conversations: {err}")
+        return False
+    finally:
+        if 'conn' in locals() and conn.is_connected():
+            conn.close()
 
 # =============================================
 # CHATBOT FUNCTIONS (FIXED)
@@ -241,7 +915,7 @@ setup_db()
 # =============================================
 # CHATBOT FUNCTIONS (ENHANCED)
 # =============================================
-def get_chatbot_response(user_message, username=None, sleep_data=None):
+def get_chatbot_response(user_message, username=None, sleep_data=None, user_stats=None, insights=None):
     """Generate appropriate response based on user message with enhanced capabilities"""
     user_message = user_message.lower().strip()
     
@@ -335,6 +1009,12 @@ def get_chatbot_response(user_message, username=None, sleep_data=None):
             else:
                 analysis.append("🔊 Noise Level: No (good) - Quiet environments improve sleep quality")
             
+            # Compare against the user's own history when there is enough of it
+            baseline_notes = compare_to_baseline(user_stats, sleep_data)
+            if baseline_notes:
+                analysis.append("\n📈 Compared to Your History:")
+                analysis.extend(f"- {note}" for note in baseline_notes)
+            
             # Add personalized recommendations
             analysis.append("\n🎯 Personalized Recommendations:")
             
@@ -351,6 +1031,14 @@ def get_chatbot_response(user_message, username=None, sleep_data=None):
             if temp < 18 or temp > 24:
                 analysis.append(f"- Adjust room temperature closer to 21°C (currently {temp}°C)")
             
+            if baseline_notes and user_stats['sleep_debt'] >= targetSleepHours / 2:
+                analysis.append("- Pay back your sleep debt with earlier bedtimes over the next few nights")
+            
+            # Longer-term insights from the nightly batch
+            if insights and insights['recommendations']:
+                analysis.append("\n📅 Your Recent Patterns:")
+                analysis.extend(f"- {rec}" for rec in insights['recommendations'])
+            
             # Add general tips
             analysis.append("\n💡 General Sleep Tips:")
             analysis.extend(random.sample(sleep_advice["general_tips"], 3))
@@ -389,22 +1077,224 @@ def save_chat_message(user_id, message, response):
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
+        timestamp = datetime.now().replace(microsecond=0)
+        # Selected from users because the partitioned table has no foreign key;
+        # a session outliving its deleted account saves nothing
         cursor.execute("""
             INSERT INTO chatbot_conversations 
-            (user_id, message, response)
-            VALUES (%s, %s, %s)
-        """, (user_id, message, response))
+            (user_id, message, response, timestamp)
+            SELECT id, %s, %s, %s FROM users WHERE id = %s
+        """, (message, response, timestamp, user_id))
+        if not cursor.rowcount:
+            return
+        index_conversation(cursor, user_id, cursor.lastrowid, timestamp, message, response)
         conn.commit()
+        mark_recent_write(user_id)
     except mysql.connector.Error as err:
         print(f"❌ Error saving chat message: {err}")
     finally:
         if 'conn' in locals() and conn.is_connected():
             conn.close()
 
+# =============================================
+# CONVERSATION SEARCH
+# =============================================
+# chatbot_conversations is searched through an inverted index of
+# (user, term, conversation) rows with term frequencies. Results are ranked
+# by tf-idf within the searched scope (one user, or everyone for admins):
+# the database sums the scores and returns one page, while the document
+# count and per-term document frequencies come from a short-lived cache.
+SEARCH_STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "but", "by", "can", "do", "for", "from",
+    "how", "i", "if", "in", "is", "it", "me", "my", "of", "on", "or", "so", "that",
+    "the", "this", "to", "was", "what", "when", "with", "you", "your"
+}
+
+def tokenize(text):
+    """Lowercase index terms of text, without stopwords"""
+    return [word[:32] for word in re.findall(r"[a-z0-9]+", text.lower())
+            if len(word) > 1 and word not in SEARCH_STOPWORDS]
+
+def search_postings(user_id, conversation_id, timestamp, message, response):
+    """chat_search_terms rows for one conversation"""
+    term_counts = Counter(tokenize(message) + tokenize(response))
+    return [(user_id, term, conversation_id, timestamp, min(count, 65535))
+            for term, count in term_counts.items()]
+
+def index_conversation(cursor, user_id, conversation_id, timestamp, message, response):
+    postings = search_postings(user_id, conversation_id, timestamp, message, response)
+    if not postings:
+        return
+    cursor.executemany("""
+        INSERT INTO chat_search_terms (user_id, term, conversation_id, conversation_time, tf)
+        VALUES (%s, %s, %s, %s, %s)
+    """, postings)
+
+def backfill_search_index(batch_size=1000):
+    """Index every stored conversation (those saved before the index existed); safe to re-run"""
+    # Conversations that are already indexed keep their rows
+    insert_sql = """
+        INSERT IGNORE INTO chat_search_terms
+        (user_id, term, conversation_id, conversation_time, tf)
+        VALUES (%s, %s, %s, %s, %s)
+    """
+    indexed = 0
+    try:
+        # Rows stream from one connection while batches are written on another
+        read_conn = get_db_connection()
+        conn = get_db_connection()
+        reader = read_conn.cursor()
+        cursor = conn.cursor()
+        reader.execute("SELECT user_id, id, timestamp, message, response FROM chatbot_conversations")
+        pending = []
+        for row in reader:
+            pending.extend(search_postings(*row))
+            indexed += 1
+            if indexed % batch_size == 0:
+                cursor.executemany(insert_sql, pending)
+                conn.commit()
+                pending = []
+        if pending:
+            cursor.executemany(insert_sql, pending)
+            conn.commit()
+        print(f"✅ Search index covers {indexed} conversations")
+        return indexed
+    except mysql.connector.Error as err:
+        print(f"❌ Error backfilling the search index: {err}")
+        return indexed
+    finally:
+        if 'read_conn' in locals() and read_conn.is_connected():
+            read_conn.close()
+        if 'conn' in locals() and conn.is_connected():
+            conn.close()
+
+# (user_id or None, term or None) -> (count, loaded_at); term None is the scope's document count
+search_stats_cache = OrderedDict()
+search_stats_lock = threading.Lock()
+
+def search_statistics(cursor, user_id, terms):
+    """(documents in scope, {term: documents containing it}), cached for searchStatsSeconds"""
+    now = time.monotonic()
+    keys = [(user_id, None)] + [(user_id, term) for term in terms]
+    with search_stats_lock:
+        cached = {}
+        for key in keys:
+            entry = search_stats_cache.get(key)
+            if entry is not None and now - entry[1] < searchStatsSeconds:
+                search_stats_cache.move_to_end(key)
+                cached[key] = entry[0]
+    
+    scope_sql = "user_id = %s AND " if user_id is not None else ""
+    scope_args = (user_id,) if user_id is not None else ()
+    loaded = {}
+    if (user_id, None) not in cached:
+        cursor.execute(f"SELECT COUNT(*) AS n FROM chatbot_conversations WHERE {scope_sql}1 = 1", scope_args)
+        loaded[(user_id, None)] = cursor.fetchone()['n']
+    missing = [term for term in terms if (user_id, term) not in cached]
+    if missing:
+        cursor.execute(f"""
+            SELECT term, COUNT(*) AS n FROM chat_search_terms
+            WHERE {scope_sql}term IN ({", ".join(["%s"] * len(missing))})
+            GROUP BY term
+        """, scope_args + tuple(missing))
+        counts = {row['term']: row['n'] for row in cursor.fetchall()}
+        loaded.update(((user_id, term), counts.get(term, 0)) for term in missing)
+    
+    if loaded:
+        with search_stats_lock:
+            for key, count in loaded.items():
+                search_stats_cache[key] = (count, now)
+                search_stats_cache.move_to_end(key)
+            while len(search_stats_cache) > searchStatsEntries:
+                search_stats_cache.popitem(last=False)
+    
+    counts = {**cached, **loaded}
+    return counts[(user_id, None)], {term: counts[(user_id, term)] for term in terms}
+
+def search_conversations(user_id, query, page=1, page_size=None):
+    """Ranked conversations matching query; user_id=None searches all users.
+    
+    Returns (results for the page, total number of matches).
+    """
+    page_size = page_size or searchPageSize
+    terms = sorted(set(tokenize(query)))
+    if not terms:
+        return [], 0
+    
+    scope_sql = "user_id = %s AND " if user_id is not None else ""
+    scope_args = (user_id,) if user_id is not None else ()
+    placeholders = ", ".join(["%s"] * len(terms))
+    try:
+        conn = get_read_connection(user_id)
+        cursor = conn.cursor(dictionary=True)
+        
+        total_docs, doc_freq = search_statistics(cursor, user_id, terms)
+        # Cached counts may trail new conversations; never divide by zero for them
+        idf = [(term, math.log(1 + max(total_docs, 1) / max(doc_freq[term], 1))) for term in terms]
+        
+        cursor.execute(f"""
+            SELECT COUNT(DISTINCT conversation_id) AS n FROM chat_search_terms
+            WHERE {scope_sql}term IN ({placeholders})
+        """, scope_args + tuple(terms))
+        total = cursor.fetchone()['n']
+        
+        cursor.execute(f"""
+            SELECT conversation_id,
+                   SUM((1 + LN(tf)) * CASE term {" ".join(["WHEN %s THEN %s"] * len(idf))} END) AS score,
+                   MAX(conversation_time) AS conversation_time
+            FROM chat_search_terms
+            WHERE {scope_sql}term IN ({placeholders})
+            GROUP BY conversation_id
+            ORDER BY score DESC, conversation_time DESC, conversation_id DESC
+            LIMIT %s OFFSET %s
+        """, tuple(itertools.chain.from_iterable(idf)) + scope_args + tuple(terms) +
+             (page_size, (page - 1) * page_size))
+        scores = {row['conversation_id']: float(row['score']) for row in cursor.fetchall()}
+        if not scores:
+            return [], total
+        
+        cursor.execute(f"""
+            SELECT id, user_id, message, response, timestamp FROM chatbot_conversations
+            WHERE {scope_sql}id IN ({", ".join(["%s"] * len(scores))})
+        """, scope_args + tuple(scores))
+        rows = {row['id']: row for row in cursor.fetchall()}
+        results = [dict(rows[cid], score=score) for cid, score in scores.items() if cid in rows]
+        return results, total
+    except mysql.connector.Error as err:
+        print(f"❌ Error searching conversations: {err}")
+        return [], 0
+    finally:
+        if 'conn' in locals() and conn.is_connected():
+            conn.close()
+
+def highlight_snippet(text, terms, width=None):
+    """Snippet of text around the first match, with matched words wrapped in html.Mark"""
+    width = width or searchSnippetChars
+    pattern = re.compile(r"\b(" + "|".join(re.escape(t) for t in terms) + r")\w*", re.IGNORECASE) if terms else None
+    match = pattern.search(text) if pattern else None
+    start = max(0, match.start() - width // 3) if match else 0
+    snippet = text[start:start + width]
+    prefix = "..." if start > 0 else ""
+    suffix = "..." if start + width < len(text) else ""
+    
+    if not pattern:
+        return [prefix + snippet + suffix]
+    children = [prefix]
+    last = 0
+    for found in pattern.finditer(snippet):
+        children.append(snippet[last:found.start()])
+        children.append(html.Mark(found.group(0)))
+        last = found.end()
+    children.append(snippet[last:] + suffix)
+    return [child for child in children if child != ""]
+
 # =============================================
 # AUTHENTICATION FUNCTIONS
 # =============================================
 def create_user(username, password, email=None):
+    if username.lower() in reservedUsernames:
+        print(f"⚠️ Username {username} is reserved")
+        return False
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
@@ -421,6 +1311,7 @@ def create_user(username, password, email=None):
             (username, generate_password_hash(password), email)
         )
         conn.commit()
+        mark_recent_write(username)
         print(f"✅ User {username} created successfully")
         return True
     except mysql.connector.Error as err:
@@ -432,7 +1323,7 @@ def create_user(username, password, email=None):
 
 def verify_user(username, password):
     try:
-        conn = get_db_connection()
+        conn = get_read_connection(username)
         cursor = conn.cursor()
         cursor.execute("SELECT password FROM users WHERE username = %s", (username,))
         result = cursor.fetchone()
@@ -446,7 +1337,7 @@ def verify_user(username, password):
 
 def get_user_id(username):
     try:
-        conn = get_db_connection()
+        conn = get_read_connection(username)
         cursor = conn.cursor()
         cursor.execute("SELECT id FROM users WHERE username = %s", (username,))
         result = cursor.fetchone()
@@ -458,6 +1349,93 @@ def get_user_id(username):
         if 'conn' in locals() and conn.is_connected():
             conn.close()
 
+def get_user_profile(username):
+    try:
+        conn = get_read_connection(username)
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute("SELECT id, username, email, is_admin, created_at FROM users WHERE username = %s",
+                       (username,))
+        profile = cursor.fetchone()
+        if profile:
+            profile['is_admin'] = bool(profile['is_admin'])
+        return profile
+    except mysql.connector.Error as err:
+        print(f"❌ Error getting user profile: {err}")
+        return None
+    finally:
+        if 'conn' in locals() and conn.is_connected():
+            conn.close()
+
+def user_is_admin(user_id):
+    """Check the admin flag on the primary, so a revoked role applies to live sessions at once"""
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT is_admin FROM users WHERE id = %s", (user_id,))
+        result = cursor.fetchone()
+        return bool(result and result[0])
+    except mysql.connector.Error as err:
+        print(f"❌ Error checking admin role: {err}")
+        return False
+    finally:
+        if 'conn' in locals() and conn.is_connected():
+            conn.close()
+
+def set_user_admin(username, is_admin=True):
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("UPDATE users SET is_admin = %s WHERE username = %s", (is_admin, username))
+        conn.commit()
+        if not cursor.rowcount:
+            print(f"⚠️ No admin change for {username} (unknown user or already set)")
+            return False
+        mark_recent_write(username)
+        print(f"✅ {username} is {'now' if is_admin else 'no longer'} an admin")
+        return True
+    except mysql.connector.Error as err:
+        print(f"❌ Error updating admin role: {err}")
+        return False
+    finally:
+        if 'conn' in locals() and conn.is_connected():
+            conn.close()
+
+def delete_user(username):
+    """Delete a user and everything stored for them.
+    
+    sleep_records and chatbot_conversations are partitioned, so neither they
+    nor the chat_search_terms index can cascade from users; they are cleared
+    here in the same transaction. Rows already exported by archive_partition
+    stay in their archive files.
+    """
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM users WHERE username = %s FOR UPDATE", (username,))
+        row = cursor.fetchone()
+        if row is None:
+            print(f"⚠️ Unknown user {username}")
+            return False
+        user_id = row[0]
+        
+        add_records_to_cohort(cursor, -1, user_id)
+        for table in ("sleep_records", "chatbot_conversations", "chat_search_terms"):
+            cursor.execute(f"DELETE FROM {table} WHERE user_id = %s", (user_id,))
+        # Stats, recommendations and device state cascade from the user row
+        cursor.execute("DELETE FROM users WHERE id = %s", (user_id,))
+        conn.commit()
+    except mysql.connector.Error as err:
+        print(f"❌ Error deleting user: {err}")
+        return False
+    finally:
+        if 'conn' in locals() and conn.is_connected():
+            conn.close()
+    
+    mark_recent_write(username)
+    sessions.revoke_user(user_id)
+    print(f"✅ Deleted {username} and their data")
+    return True
+
 # =============================================
 # SLEEP ANALYSIS FUNCTIONS (IMPROVED)
 # =============================================
@@ -484,35 +1462,103 @@ def analyze_sleep(data):
         
     return max(sleep_score, 0)  # Ensure score doesn't go below 0
 
-def save_sleep_record(user_id, data, score):
+def parse_sleep_entry(record):
+    """Validate a submitted entry and coerce it to the types analyze_sleep expects"""
+    if record['light_exposure'] not in ('yes', 'no') or record['noise_level'] not in ('yes', 'no'):
+        raise ValueError("light_exposure and noise_level must be 'yes' or 'no'")
+    
+    data = {
+        'sleep_hours': float(record['sleep_hours']),
+        'disturbances': int(record['disturbances']),
+        'temperature': float(record['temperature']),
+        'light_exposure': record['light_exposure'],
+        'noise_level': record['noise_level']
+    }
+    if not 0 <= data['sleep_hours'] <= 24 or data['disturbances'] < 0:
+        raise ValueError("sleep entry out of range")
+    return data
+
+def sleep_night(timestamp):
+    """Date of the night an entry made at timestamp describes"""
+    return (timestamp - timedelta(hours=nightRolloverHour)).date()
+
+def save_sleep_record(user_id, data, score, submission_id=None, retry=True):
+    """Insert (or, in one-per-night mode, upsert) an entry.
+    
+    Returns True when written, False for a duplicate submission and None
+    when the database refused the entry.
+    """
     try:
         conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO sleep_records 
-            (user_id, sleep_hours, disturbances, temperature, 
-             light_exposure, noise_level, sleep_score)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-        """, (
-            user_id,
-            data['sleep_hours'],
-            data['disturbances'],
-            data['temperature'],
-            data['light_exposure'],
-            data['noise_level'],
-            score
-        ))
+        cursor = conn.cursor(dictionary=True)
+        values = encode_sleep_record(data, score)
+        night = sleep_night(datetime.now())
+        night_slot = 1 if onePerNightUpsert else None
+        replaced = None
+        
+        if onePerNightUpsert:
+            cursor.execute("""
+                SELECT * FROM sleep_records
+                WHERE user_id = %s AND sleep_date = %s AND night_slot = 1
+                FOR UPDATE
+            """, (user_id, night))
+            existing = cursor.fetchone()
+            if existing and submission_id and existing['submission_id'] == submission_id:
+                conn.rollback()
+                print("⚠️ Duplicate sleep submission ignored")
+                return False
+            if existing:
+                cursor.execute("""
+                    UPDATE sleep_records
+                    SET sleep_hours = %s, disturbances = %s, temperature = %s,
+                        env_flags = %s, sleep_score = %s, submission_id = %s,
+                        record_date = CURRENT_TIMESTAMP
+                    WHERE id = %s AND sleep_date = %s
+                """, values + (submission_id, existing['id'], night))
+                replaced = decode_sleep_record(existing)
+        
+        if replaced is None:
+            cursor.execute("""
+                INSERT INTO sleep_records 
+                (user_id, sleep_hours, disturbances, temperature, 
+                 env_flags, sleep_score, sleep_date, night_slot, submission_id)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """, (user_id,) + values + (night, night_slot, submission_id))
+        
+        # Fold the new entry into the user's baseline and the cohort sketch
+        # in the same transaction
+        update_user_stats(cursor, user_id, data, score, night, replaced)
+        if replaced:
+            record_cohort_sample(cursor, night, replaced, replaced['sleep_score'], -1)
+        record_cohort_sample(cursor, night, data, score)
         conn.commit()
+        mark_recent_write(user_id)
+        sessions.invalidate(user_id)
         print("✅ Sleep record saved successfully")
+        return True
+    except mysql.connector.IntegrityError as err:
+        # Unique (user_id, submission_id) key: another worker already saved this submission
+        if err.errno == 1062 and 'uq_user_submission' in str(err):
+            print("⚠️ Duplicate sleep submission ignored")
+            return False
+        # Unique night key: another submission inserted tonight's row after our SELECT
+        if not (err.errno == 1062 and onePerNightUpsert and retry):
+            print(f"❌ Error saving sleep record: {err}")
+            return None
+        print("⚠️ Tonight's entry was saved concurrently, retrying as an update")
     except mysql.connector.Error as err:
         print(f"❌ Error saving sleep record: {err}")
+        return None
     finally:
         if 'conn' in locals() and conn.is_connected():
             conn.close()
+    
+    # The row now exists, so the retry locks it and updates it
+    return save_sleep_record(user_id, data, score, submission_id, retry=False)
 
 def get_user_records(user_id, limit=None):
     try:
-        conn = get_db_connection()
+        conn = get_read_connection(user_id)
         cursor = conn.cursor(dictionary=True)
         query = """
             SELECT * FROM sleep_records 
@@ -522,7 +1568,7 @@ def get_user_records(user_id, limit=None):
         if limit:
             query += f" LIMIT {limit}"
         cursor.execute(query, (user_id,))
-        return cursor.fetchall()
+        return [decode_sleep_record(row) for row in cursor.fetchall()]
     except mysql.connector.Error as err:
         print(f"❌ Error getting records: {err}")
         return []
@@ -530,14 +1576,1354 @@ def get_user_records(user_id, limit=None):
         if 'conn' in locals() and conn.is_connected():
             conn.close()
 
+# =============================================
+# REQUEST COALESCING
+# =============================================
+class SingleFlight:
+    """Run one call per key at a time; concurrent callers share its result.
+    
+    Finished calls are remembered for ttl seconds, so a repeated key within
+    that window is reported as shared instead of running the work again.
+    """
+    def __init__(self, ttl=0):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._calls = {}
+    
+    def do(self, key, fn):
+        """Return (result, shared) where shared means another call did the work"""
+        with self._lock:
+            now = time.monotonic()
+            for old_key in [k for k, c in self._calls.items()
+                            if c['done_at'] is not None and now - c['done_at'] >= self.ttl]:
+                del self._calls[old_key]
+            
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {'event': threading.Event(), 'result': None, 'done_at': None}
+                self._calls[key] = call
+        
+        if not leader:
+            call['event'].wait()
+            return call['result'], True
+        
+        try:
+            call['result'] = fn()
+        except Exception:
+            with self._lock:
+                self._calls.pop(key, None)
+            raise
+        finally:
+            call['done_at'] = time.monotonic()
+            call['event'].set()
+        return call['result'], False
+
+# Submissions are remembered briefly so double-clicks never insert twice;
+# record reads are only shared while in flight (history + trends refresh together)
+submission_flight = SingleFlight(ttl=duplicateSubmitWindow)
+record_reads_flight = SingleFlight()
+
+def get_chart_record_columns(user_id):
+    """The user's entries in the chart window as columns, coalescing concurrent reads for the same user"""
+    since = chart_window_start()
+    columns, _ = record_reads_flight.do((user_id, since), lambda: get_user_record_columns(user_id, since))
+    return columns
+
+# =============================================
+# SESSION STORE
+# =============================================
+class SessionStore:
+    """Server-side sessions keyed by signed opaque tokens.
+    
+    The browser only holds "<session id>.<HMAC>"; the user's profile lives
+    here in an LRU of sessions. Per-user data (records, stats, insights) is
+    cached in a second LRU shared by the user's sessions and bounded by
+    cache_rows, so a list of 365 records costs 365 of the budget. With a
+    backend (a diskcache.Cache) profiles are also written through so logins
+    survive restarts; cached data stays in memory and is dropped by
+    invalidate() whenever the user's data changes.
+    """
+    def __init__(self, secret, max_entries, idle_seconds, cache_rows, backend=None):
+        self._key = secret.encode()
+        self.max_entries = max_entries
+        self.idle_seconds = idle_seconds
+        self.cache_rows = cache_rows
+        self.backend = backend
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+        self._by_user = defaultdict(set)
+        self._cache = OrderedDict()          # (user_id, key) -> (value, rows, loaded_at)
+        self._cache_keys = defaultdict(set)  # user_id -> cached keys
+        self._cache_used = 0
+        self._generation = 0                 # Bumped by every invalidation
+    
+    def _sign(self, session_id):
+        return hmac.new(self._key, session_id.encode(), hashlib.sha256).hexdigest()
+    
+    def _session_id(self, token):
+        """The session id of a correctly signed token, else None"""
+        if not isinstance(token, str):
+            return None
+        session_id, _, signature = token.partition('.')
+        if session_id and hmac.compare_digest(signature, self._sign(session_id)):
+            return session_id
+        return None
+    
+    def _insert(self, session_id, session):
+        # Caller holds the lock
+        self._sessions[session_id] = session
+        self._by_user[session['profile']['id']].add(session_id)
+        while len(self._sessions) > self.max_entries:
+            self._remove(next(iter(self._sessions)))
+    
+    def _remove(self, session_id):
+        # Caller holds the lock
+        session = self._sessions.pop(session_id, None)
+        if session is not None:
+            user_id = session['profile']['id']
+            self._by_user[user_id].discard(session_id)
+            if not self._by_user[user_id]:
+                del self._by_user[user_id]
+    
+    def create(self, profile):
+        """Start a session for a user profile and return its token"""
+        session_id = secrets.token_urlsafe(24)
+        now = time.time()
+        with self._lock:
+            self._insert(session_id, {'profile': profile, 'last_seen': now, 'persisted_at': now})
+        if self.backend is not None:
+            self.backend.set(session_id, profile, expire=self.idle_seconds)
+        return f"{session_id}.{self._sign(session_id)}"
+    
+    def get(self, token):
+        """The session behind a token, or None when it is missing, forged or expired"""
+        session_id = self._session_id(token)
+        if session_id is None:
+            return None
+        
+        now = time.time()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None and now - session['last_seen'] > self.idle_seconds:
+                self._remove(session_id)
+                session = None
+                expired = True
+            else:
+                expired = False
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+                session['last_seen'] = now
+        
+        if session is None and self.backend is not None:
+            if expired:
+                self.backend.delete(session_id)
+                return None
+            profile = self.backend.get(session_id)
+            if profile is None:
+                return None
+            with self._lock:
+                session = self._sessions.get(session_id)
+                if session is None:
+                    session = {'profile': profile, 'last_seen': now, 'persisted_at': now}
+                    self._insert(session_id, session)
+        
+        # Keep the persisted copy alive without writing on every callback
+        if (session is not None and self.backend is not None
+                and now - session['persisted_at'] > self.idle_seconds / 2):
+            session['persisted_at'] = now
+            self.backend.touch(session_id, expire=self.idle_seconds)
+        return session
+    
+    def revoke(self, token):
+        """End a session (logout)"""
+        session_id = self._session_id(token)
+        if session_id is None:
+            return
+        with self._lock:
+            self._remove(session_id)
+        if self.backend is not None:
+            self.backend.delete(session_id)
+    
+    def revoke_user(self, user_id):
+        """End every session of a user and drop their cached data (account deletion)"""
+        with self._lock:
+            session_ids = list(self._by_user.get(user_id, ()))
+            for session_id in session_ids:
+                self._remove(session_id)
+        if self.backend is not None:
+            for session_id in session_ids:
+                self.backend.delete(session_id)
+        self.invalidate(user_id)
+    
+    @staticmethod
+    def _rows(value):
+        """Cache cost of a value: rows for record lists and column dicts, else 1"""
+        if isinstance(value, list):
+            return max(len(value), 1)
+        if isinstance(value, dict) and value and all(isinstance(v, np.ndarray) for v in value.values()):
+            return max(len(next(iter(value.values()))), 1)
+        return 1
+    
+    def _drop(self, cache_key):
+        # Caller holds the lock
+        _, rows, _ = self._cache.pop(cache_key)
+        self._cache_used -= rows
+        user_id, key = cache_key
+        self._cache_keys[user_id].discard(key)
+        if not self._cache_keys[user_id]:
+            del self._cache_keys[user_id]
+    
+    def cached(self, session, key, loader):
+        """A cached value of the session user's data, computed by loader on a miss.
+        
+        An entry loaded before the client's last write (possibly made on
+        another worker, which this process never saw invalidate) is reloaded.
+        """
+        cache_key = (session['profile']['id'], key)
+        written_at = client_last_write.get()
+        with self._lock:
+            entry = self._cache.get(cache_key)
+            if entry is not None and (written_at is None or entry[2] >= written_at):
+                self._cache.move_to_end(cache_key)
+                return entry[0]
+            if entry is not None:
+                self._drop(cache_key)
+            generation = self._generation
+        
+        loaded_at = time.time()
+        value = loader()
+        rows = self._rows(value)
+        with self._lock:
+            # Don't store a value loaded before an invalidation landed
+            if self._generation == generation and cache_key not in self._cache and rows <= self.cache_rows:
+                self._cache[cache_key] = (value, rows, loaded_at)
+                self._cache_used += rows
+                self._cache_keys[cache_key[0]].add(key)
+                while self._cache_used > self.cache_rows:
+                    self._drop(next(iter(self._cache)))
+        return value
+    
+    def invalidate(self, user_id=None, keys=None):
+        """Drop cached data (all of it, or only keys) for one user, or for everyone"""
+        with self._lock:
+            self._generation += 1
+            user_ids = list(self._cache_keys) if user_id is None else [user_id]
+            for uid in user_ids:
+                for key in list(self._cache_keys.get(uid, ())):
+                    if keys is None or key in keys:
+                        self._drop((uid, key))
+
+if sessionDir and diskcache is None:
+    print("⚠️ sessionDir needs the diskcache package; sessions are kept in memory only")
+
+# Persisted sessions are read by every worker and after restarts, so they
+# must all sign with the same key. In-memory sessions live and die with
+# their process anyway, where a random key only costs logins on restart.
+if not sessionSecret:
+    if sessionDir and __name__ != '__main__':
+        raise RuntimeError("Set SESSION_SECRET when sessionDir is used; all workers must share it")
+    if not sessionDir:
+        print("⚠️ SESSION_SECRET is not set; using a random key, so logins end when the process restarts")
+
+sessions = SessionStore(
+    sessionSecret or secrets.token_hex(32),
+    sessionMaxEntries,
+    sessionIdleSeconds,
+    sessionCacheRows,
+    backend=diskcache.Cache(sessionDir) if sessionDir and diskcache is not None else None
+)
+
+def session_record_columns(session):
+    return sessions.cached(session, ('record-columns', chart_window_start()),
+                           lambda: get_chart_record_columns(session['profile']['id']))
+
+def session_stats(session):
+    return sessions.cached(session, 'stats', lambda: get_user_stats(session['profile']['id']))
+
+def session_insights(session):
+    return sessions.cached(session, 'insights', lambda: get_precomputed_recommendations(session['profile']['id']))
+
+# =============================================
+# PERSONAL BASELINE FUNCTIONS
+# =============================================
+STATS_METRICS = {
+    'hours': 'sleep_hours',
+    'score': 'sleep_score',
+    'disturbances': 'disturbances'
+}
+
+# The streak and sleep debt step once per night. last_night is the newest
+# night counted and the prev_* fields hold the values from before it, so a
+# later entry for the same night redoes that night's step instead of adding one.
+
+def empty_user_stats():
+    stats = {'record_count': 0, 'current_streak': 0, 'best_streak': 0, 'sleep_debt': 0.0,
+             'last_night': None, 'prev_streak': 0, 'prev_best_streak': 0, 'prev_sleep_debt': 0.0}
+    for metric in STATS_METRICS:
+        stats[f'mean_{metric}'] = 0.0
+        stats[f'm2_{metric}'] = 0.0
+    return stats
+
+def baseline_snapshot(stats):
+    """JSON-safe copy of the stats fields an entry is compared against"""
+    if not stats:
+        return None
+    fields = ['record_count', 'current_streak', 'best_streak', 'sleep_debt']
+    fields += [f'{prefix}_{metric}' for metric in STATS_METRICS for prefix in ('mean', 'm2')]
+    return {field: stats[field] for field in fields}
+
+def count_night(stats, night, hours):
+    """Advance the good-sleep streak and sleep debt for night (in place).
+    
+    Surplus sleep pays debt back, never below 0. A skipped night ends the
+    streak. Nights older than last_night only reach the means; rebuilding
+    the stats replays them in order.
+    """
+    last_night = stats['last_night']
+    if last_night is not None and night < last_night:
+        return
+    if last_night is None or night > last_night:
+        consecutive = last_night is not None and (night - last_night).days == 1
+        stats['prev_streak'] = stats['current_streak'] if consecutive else 0
+        stats['prev_best_streak'] = stats['best_streak']
+        stats['prev_sleep_debt'] = stats['sleep_debt']
+        stats['last_night'] = night
+    
+    stats['current_streak'] = stats['prev_streak'] + 1 if hours >= streakMinHours else 0
+    stats['best_streak'] = max(stats['prev_best_streak'], stats['current_streak'])
+    stats['sleep_debt'] = max(0.0, stats['prev_sleep_debt'] + targetSleepHours - hours)
+
+def apply_record_to_stats(stats, data, score, night):
+    """Return stats updated with one more record (Welford's online mean/variance)"""
+    stats = dict(stats)
+    values = {'hours': float(data['sleep_hours']),
+              'score': float(score),
+              'disturbances': float(data['disturbances'])}
+    
+    n = stats['record_count'] + 1
+    for metric, value in values.items():
+        mean = stats[f'mean_{metric}']
+        delta = value - mean
+        mean += delta / n
+        stats[f'mean_{metric}'] = mean
+        stats[f'm2_{metric}'] += delta * (value - mean)
+    stats['record_count'] = n
+    
+    count_night(stats, night, values['hours'])
+    return stats
+
+def remove_record_from_stats(stats, record):
+    """Return stats with a previously applied record taken back out.
+    
+    Means and variances are reversed exactly. The streak and sleep debt are
+    left alone: the replacing entry is for the same night, so applying it
+    redoes that night's step.
+    """
+    if stats['record_count'] <= 1:
+        return empty_user_stats()
+    
+    stats = dict(stats)
+    values = {'hours': float(record['sleep_hours']),
+              'score': float(record['sleep_score']),
+              'disturbances': float(record['disturbances'])}
+    n = stats['record_count']
+    for metric, value in values.items():
+        mean = stats[f'mean_{metric}']
+        prev_mean = (n * mean - value) / (n - 1)
+        stats[f'mean_{metric}'] = prev_mean
+        stats[f'm2_{metric}'] = max(0.0, stats[f'm2_{metric}'] - (value - prev_mean) * (value - mean))
+    stats['record_count'] = n - 1
+    return stats
+
+def stats_std(stats, metric):
+    """Sample standard deviation of a tracked metric"""
+    if stats['record_count'] < 2:
+        return 0.0
+    return (stats[f'm2_{metric}'] / (stats['record_count'] - 1)) ** 0.5
+
+def update_user_stats(cursor, user_id, data, score, night, replaced=None):
+    """Update the user's baseline row in O(1) using the caller's dictionary cursor"""
+    cursor.execute("SELECT * FROM user_sleep_stats WHERE user_id = %s FOR UPDATE", (user_id,))
+    row = cursor.fetchone()
+    stats = dict(row) if row else empty_user_stats()
+    
+    if replaced:
+        stats = remove_record_from_stats(stats, replaced)
+    stats = apply_record_to_stats(stats, data, score, night)
+    cursor.execute(USER_STATS_REPLACE, user_stats_values(user_id, stats))
+
+USER_STATS_REPLACE = """
+    REPLACE INTO user_sleep_stats
+    (user_id, record_count, mean_hours, m2_hours, mean_score, m2_score,
+     mean_disturbances, m2_disturbances, current_streak, best_streak, sleep_debt,
+     last_night, prev_streak, prev_best_streak, prev_sleep_debt)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+"""
+
+def user_stats_values(user_id, stats):
+    return (
+        user_id,
+        stats['record_count'],
+        stats['mean_hours'],
+        stats['m2_hours'],
+        stats['mean_score'],
+        stats['m2_score'],
+        stats['mean_disturbances'],
+        stats['m2_disturbances'],
+        stats['current_streak'],
+        stats['best_streak'],
+        stats['sleep_debt'],
+        stats['last_night'],
+        stats['prev_streak'],
+        stats['prev_best_streak'],
+        stats['prev_sleep_debt']
+    )
+
+def rebuild_user_stats(batch_size=1000):
+    """Recompute every user's baseline from their stored records, oldest first (e.g. after a migration)"""
+    rebuilt = 0
+    try:
+        # Rows stream from one connection while batches are written on another
+        read_conn = get_db_connection()
+        conn = get_db_connection()
+        reader = read_conn.cursor(dictionary=True)
+        cursor = conn.cursor()
+        reader.execute("""
+            SELECT user_id, sleep_hours, disturbances, sleep_score, sleep_date
+            FROM sleep_records ORDER BY user_id, sleep_date, record_date
+        """)
+        pending = []
+        user_id, stats = None, None
+        for row in reader:
+            if row['user_id'] != user_id:
+                if user_id is not None:
+                    pending.append(user_stats_values(user_id, stats))
+                user_id, stats = row['user_id'], empty_user_stats()
+            stats = apply_record_to_stats(stats, row, row['sleep_score'], row['sleep_date'])
+            if len(pending) >= batch_size:
+                cursor.executemany(USER_STATS_REPLACE, pending)
+                conn.commit()
+                rebuilt += len(pending)
+                pending = []
+        if user_id is not None:
+            pending.append(user_stats_values(user_id, stats))
+        if pending:
+            cursor.executemany(USER_STATS_REPLACE, pending)
+            conn.commit()
+            rebuilt += len(pending)
+        print(f"✅ Rebuilt baseline stats for {rebuilt} users")
+        return rebuilt
+    except mysql.connector.Error as err:
+        print(f"❌ Error rebuilding sleep stats: {err}")
+        return rebuilt
+    finally:
+        if 'read_conn' in locals() and read_conn.is_connected():
+            read_conn.close()
+        if 'conn' in locals() and conn.is_connected():
+            conn.close()
+
+def get_user_stats(user_id):
+    try:
+        conn = get_read_connection(user_id)
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute("SELECT * FROM user_sleep_stats WHERE user_id = %s", (user_id,))
+        return cursor.fetchone()
+    except mysql.connector.Error as err:
+        print(f"❌ Error getting sleep stats: {err}")
+        return None
+    finally:
+        if 'conn' in locals() and conn.is_connected():
+            conn.close()
+
+def compare_to_baseline(stats, sleep_data):
+    """Describe how an entry compares with the user's own history"""
+    if not stats or stats['record_count'] < baselineMinRecords:
+        return []
+    
+    notes = []
+    labels = {'hours': ("Sleep duration", "h"), 'score': ("Sleep score", ""),
+              'disturbances': ("Disturbances", "")}
+    for metric, field in STATS_METRICS.items():
+        value = sleep_data.get(field)
+        if value is None:
+            continue
+        mean = stats[f'mean_{metric}']
+        std = stats_std(stats, metric)
+        label, unit = labels[metric]
+        
+        # Differences within one standard deviation count as a normal night
+        if abs(value - mean) > max(std, 1e-9):
+            # Fewer disturbances is better, unlike hours and score
+            better = (value < mean) if metric == 'disturbances' else (value > mean)
+            direction = "better than" if better else "worse than"
+        else:
+            direction = "in line with"
+        notes.append(f"{label}: {value:g}{unit} is {direction} your average of {mean:.1f}{unit}")
+    
+    if stats['current_streak'] > 1:
+        notes.append(f"You're on a {stats['current_streak']}-night streak of {streakMinHours:g}+ hours "
+                     f"(best: {stats['best_streak']})")
+    if stats['sleep_debt'] >= 1:
+        notes.append(f"Accumulated sleep debt: {stats['sleep_debt']:.1f} hours below your "
+                     f"{targetSleepHours:g}-hour target")
+    return notes
+
+# =============================================
+# COHORT ANALYTICS FUNCTIONS
+# =============================================
+# Population distributions are kept as per-day histograms. Both metrics have
+# small bounded domains (scores 0-100, hours 0-24 at 0.1h), so a fixed-bin
+# histogram is an exact, mergeable sketch: merging days is a SUM by bin and
+# the table size depends only on the number of days, never on row count.
+COHORT_METRICS = {
+    'sleep_score': {'label': "Sleep Score", 'bins_per_unit': 1},
+    'sleep_hours': {'label': "Sleep Hours", 'bins_per_unit': 10}
+}
+
+def record_cohort_sample(cursor, night, data, score, delta=1):
+    """Add (or with delta=-1, remove) one entry from the night's histograms"""
+    values = {'sleep_score': score, 'sleep_hours': data['sleep_hours']}
+    cursor.executemany("""
+        INSERT INTO cohort_histograms (bucket_date, metric, bin, count)
+        VALUES (%s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE count = count + VALUES(count)
+    """, [
+        (night, metric, int(round(float(values[metric]) * info['bins_per_unit'])), delta)
+        for metric, info in COHORT_METRICS.items()
+    ])
+
+def add_records_to_cohort(cursor, delta=1, user_id=None):
+    """Add (or with delta=-1, remove) stored entries, everyone's or one user's, in bulk"""
+    for metric, info in COHORT_METRICS.items():
+        user_filter = "WHERE user_id = %s" if user_id is not None else ""
+        cursor.execute(f"""
+            INSERT INTO cohort_histograms (bucket_date, metric, bin, count)
+            SELECT sleep_date, %s, ROUND({metric} * {info['bins_per_unit']}), %s * COUNT(*)
+            FROM sleep_records {user_filter}
+            GROUP BY sleep_date, ROUND({metric} * {info['bins_per_unit']})
+            ON DUPLICATE KEY UPDATE count = count + VALUES(count)
+        """, (metric, delta) + ((user_id,) if user_id is not None else ()))
+
+def get_cohort_histograms(start_date, end_date, by_day=False):
+    """Merged histograms {metric: {value: count}}, or {day: {metric: {...}}} when by_day"""
+    try:
+        conn = get_read_connection()
+        cursor = conn.cursor()
+        if by_day:
+            cursor.execute("""
+                SELECT bucket_date, metric, bin, count FROM cohort_histograms
+                WHERE bucket_date BETWEEN %s AND %s AND count > 0
+                ORDER BY bucket_date
+            """, (start_date, end_date))
+            rows = cursor.fetchall()
+        else:
+            cursor.execute("""
+                SELECT NULL, metric, bin, SUM(count) FROM cohort_histograms
+                WHERE bucket_date BETWEEN %s AND %s
+                GROUP BY metric, bin
+                HAVING SUM(count) > 0
+            """, (start_date, end_date))
+            rows = cursor.fetchall()
+        
+        result = {}
+        for day, metric, bin_index, count in rows:
+            if metric not in COHORT_METRICS:
+                continue
+            target = result.setdefault(day, {}) if by_day else result
+            value = bin_index / COHORT_METRICS[metric]['bins_per_unit']
+            target.setdefault(metric, {})[value] = int(count)
+        return result
+    except mysql.connector.Error as err:
+        print(f"❌ Error getting cohort histograms: {err}")
+        return {}
+    finally:
+        if 'conn' in locals() and conn.is_connected():
+            conn.close()
+
+def histogram_percentiles(histogram, percentiles):
+    """Nearest-rank percentiles of a {value: count} histogram"""
+    total = sum(histogram.values())
+    if not total:
+        return {}
+    
+    results = {}
+    targets = sorted(percentiles)
+    cumulative = 0
+    for value in sorted(histogram):
+        cumulative += histogram[value]
+        while targets and cumulative >= max(1, -(-targets[0] * total // 100)):
+            results[targets.pop(0)] = value
+    return results
+
+# =============================================
+# BATCH RECOMMENDATIONS
+# =============================================
+# Richer recommendations are computed nightly for every user in a process
+# pool and stored one row per user, so the dashboard only reads them.
+FACTOR_ADVICE = {
+    'short_sleep': "Short nights cost you the most points - move your bedtime 30 minutes earlier",
+    'disturbances': "Disturbances cost you the most points - find and remove what wakes you up",
+    'temperature': "Room temperature costs you the most points - keep the bedroom between 18-24°C",
+    'light': "Light exposure costs you the most points - try blackout curtains or a sleep mask",
+    'noise': "Noise costs you the most points - try earplugs or a white noise machine"
+}
+
+def score_penalties(record):
+    """Points analyze_sleep deducted for each negative factor"""
+    hours = record['sleep_hours']
+    return {
+        'short_sleep': 30 if hours < 6 else 15 if hours < 7 else 0,
+        'disturbances': record['disturbances'] * 5 if record['disturbances'] > 2 else 0,
+        'temperature': 10 if record['temperature'] < 18 or record['temperature'] > 24 else 0,
+        'light': 20 if record['light_exposure'] == 'yes' else 0,
+        'noise': 15 if record['noise_level'] == 'yes' else 0
+    }
+
+def build_recommendations(records):
+    """Trend, dominant factor and weekday/weekend insights from a user's records"""
+    records = sorted(records, key=lambda r: r['sleep_date'])
+    first_night = records[0]['sleep_date']
+    days = np.array([(r['sleep_date'] - first_night).days for r in records], dtype=float)
+    scores = np.array([r['sleep_score'] for r in records], dtype=float)
+    
+    # Least-squares slope of score over time, in points per week
+    trend_per_week = float(np.polyfit(days, scores, 1)[0] * 7) if np.ptp(days) > 0 else 0.0
+    if trend_per_week > 1:
+        trend_direction = 'improving'
+    elif trend_per_week < -1:
+        trend_direction = 'declining'
+    else:
+        trend_direction = 'stable'
+    
+    totals = Counter()
+    for record in records:
+        totals.update(score_penalties(record))
+    dominant_factor = max(totals, key=totals.get) if any(totals.values()) else None
+    
+    # Friday and Saturday nights count as the weekend
+    weekend = np.array([r['sleep_date'].weekday() in (4, 5) for r in records])
+    weekday_avg = float(scores[~weekend].mean()) if (~weekend).any() else None
+    weekend_avg = float(scores[weekend].mean()) if weekend.any() else None
+    
+    recommendations = []
+    if trend_direction == 'improving':
+        recommendations.append(f"Your sleep score is improving by {trend_per_week:.1f} points a week - keep it up")
+    elif trend_direction == 'declining':
+        recommendations.append(f"Your sleep score is dropping by {-trend_per_week:.1f} points a week - "
+                               "look at what changed recently")
+    if dominant_factor:
+        recommendations.append(FACTOR_ADVICE[dominant_factor])
+    if weekday_avg is not None and weekend_avg is not None and abs(weekday_avg - weekend_avg) > 5:
+        worse = "weekend" if weekend_avg < weekday_avg else "weekday"
+        recommendations.append(f"Your {worse} nights score {abs(weekday_avg - weekend_avg):.0f} points lower - "
+                               "keep the same schedule all week")
+    
+    return {
+        'record_count': len(records),
+        'trend_direction': trend_direction,
+        'trend_per_week': trend_per_week,
+        'dominant_factor': dominant_factor,
+        'weekday_avg_score': weekday_avg,
+        'weekend_avg_score': weekend_avg,
+        'recommendations': recommendations
+    }
+
+def compute_user_recommendations(user_id):
+    """Pool worker: (user_id, insights) or (user_id, None) when there is too little data"""
+    try:
+        conn = get_read_connection()
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute("""
+            SELECT sleep_hours, disturbances, temperature, env_flags, sleep_score, sleep_date
+            FROM sleep_records
+            WHERE user_id = %s AND sleep_date >= %s
+        """, (user_id, date.today() - timedelta(days=recommendationWindowDays)))
+        records = [decode_sleep_record(row) for row in cursor.fetchall()]
+        if len(records) < recommendationMinRecords:
+            return user_id, None
+        return user_id, build_recommendations(records)
+    except mysql.connector.Error as err:
+        print(f"❌ Error computing recommendations for user {user_id}: {err}")
+        return user_id, None
+    finally:
+        if 'conn' in locals() and conn.is_connected():
+            conn.close()
+
+def run_recommendation_batch(processes=None, write_batch_size=500):
+    """Recompute every user's recommendations in parallel and store them"""
+    started = time.monotonic()
+    stored = 0
+    try:
+        conn = get_db_connection()
+        if not acquire_job_lock(conn, "recommendation-batch"):
+            print("⚠️ Recommendation batch already running in another process")
+            return stored
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM users")
+        user_ids = [row[0] for row in cursor.fetchall()]
+        
+        insert_sql = """
+            REPLACE INTO precomputed_recommendations
+            (user_id, record_count, trend_direction, trend_per_week, dominant_factor,
+             weekday_avg_score, weekend_avg_score, recommendations)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        """
+        pending = []
+        # The batch runs from a thread of a multi-threaded server, where a forked
+        # child can inherit a lock some other thread held; spawned workers start
+        # clean, and importing this module does not touch the database
+        pool_context = multiprocessing.get_context("spawn")
+        with pool_context.Pool(processes or recommendationProcesses) as pool:
+            for user_id, insights in pool.imap_unordered(compute_user_recommendations, user_ids, chunksize=16):
+                if insights is None:
+                    continue
+                pending.append((
+                    user_id,
+                    insights['record_count'],
+                    insights['trend_direction'],
+                    insights['trend_per_week'],
+                    insights['dominant_factor'],
+                    insights['weekday_avg_score'],
+                    insights['weekend_avg_score'],
+                    json.dumps(insights['recommendations'])
+                ))
+                if len(pending) >= write_batch_size:
+                    cursor.executemany(insert_sql, pending)
+                    conn.commit()
+                    stored += len(pending)
+                    pending = []
+        if pending:
+            cursor.executemany(insert_sql, pending)
+            conn.commit()
+            stored += len(pending)
+        
+        sessions.invalidate(keys=['insights'])
+        print(f"✅ Recommendations stored for {stored}/{len(user_ids)} users "
+              f"in {time.monotonic() - started:.1f}s")
+        return stored
+    except mysql.connector.Error as err:
+        print(f"❌ Error running recommendation batch: {err}")
+        return stored
+    finally:
+        if 'conn' in locals() and conn.is_connected():
+            conn.close()
+
+def start_recommendation_scheduler():
+    """Run the recommendation batch every night at recommendationHour"""
+    def loop():
+        while True:
+            now = datetime.now()
+            next_run = now.replace(hour=recommendationHour, minute=0, second=0, microsecond=0)
+            if next_run <= now:
+                next_run += timedelta(days=1)
+            time.sleep((next_run - now).total_seconds())
+            try:
+                run_recommendation_batch()
+            except Exception as err:  # A failed run must not stop the schedule
+                print(f"❌ Recommendation batch failed: {err}")
+    
+    thread = threading.Thread(target=loop, name="recommendation-batch", daemon=True)
+    thread.start()
+    return thread
+
+def get_precomputed_recommendations(user_id):
+    try:
+        conn = get_read_connection(user_id)
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute("SELECT * FROM precomputed_recommendations WHERE user_id = %s", (user_id,))
+        row = cursor.fetchone()
+        if row:
+            row['recommendations'] = json.loads(row['recommendations'])
+        return row
+    except mysql.connector.Error as err:
+        print(f"❌ Error getting recommendations: {err}")
+        return None
+    finally:
+        if 'conn' in locals() and conn.is_connected():
+            conn.close()
+
+# =============================================
+# DEVICE INGESTION
+# =============================================
+# Spool files are streamed through generators (read -> validate -> aggregate
+# per night -> batch), so memory is bounded by the users seen in a run and
+# one write batch, never by the file size. Each user's open night is saved in
+# device_open_nights after every file and closed deviceLateHours after it
+# ends, so a night split across files is scored once. Samples are
+# {user, timestamp, movement, noise, light[, temperature]}.
+def read_spool_file(path):
+    """Yield each sample of a .csv or .jsonl spool file as a dict (None for unparsable lines)"""
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.endswith('.csv'):
+            yield from csv.DictReader(f)
+            return
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                sample = json.loads(line)
+            except ValueError:
+                sample = None
+            yield sample if isinstance(sample, dict) else None
+
+def validate_samples(samples, report, user_ids):
+    """Yield (user_id, timestamp, movement, noise, light, temperature), counting rejects"""
+    for sample in samples:
+        report['samples'] += 1
+        try:
+            username = sample['user']
+            if username not in user_ids:
+                user_ids[username] = get_user_id(username)
+            timestamp = datetime.fromisoformat(str(sample['timestamp']))
+            if timestamp.tzinfo is not None:
+                timestamp = timestamp.astimezone().replace(tzinfo=None)
+            movement = float(sample['movement'])
+            noise = float(sample['noise'])
+            light = float(sample['light'])
+            temperature = sample.get('temperature')
+            temperature = float(temperature) if temperature not in (None, '') else None
+        except (KeyError, TypeError, ValueError):
+            report['rejected'] += 1
+            continue
+        
+        if (user_ids[username] is None or movement < 0 or not 0 <= noise <= 150 or light < 0
+                or (temperature is not None and not -10 <= temperature <= 50)):
+            report['rejected'] += 1
+            continue
+        yield user_ids[username], timestamp, movement, noise, light, temperature
+
+def new_night(user_id, night):
+    return {'user_id': user_id, 'night': night, 'minutes': 0, 'asleep': 0, 'slept': False,
+            'awake_run': 0, 'disturbances': 0, 'noisy': 0, 'lit': 0,
+            'temp_sum': 0.0, 'temp_count': 0, 'last_seen': None, 'closed': False}
+
+def load_open_nights(user_ids=None, before=None):
+    """Saved accumulators by user_id, for the given users or for open nights before a date.
+    
+    Raises mysql.connector.Error so the caller can leave the file for a retry.
+    """
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        if user_ids is not None:
+            cursor.execute(f"""
+                SELECT user_id, state FROM device_open_nights
+                WHERE user_id IN ({', '.join(['%s'] * len(user_ids))})
+            """, list(user_ids))
+        else:
+            cursor.execute("""
+                SELECT user_id, state FROM device_open_nights
+                WHERE closed = FALSE AND sleep_date < %s
+            """, (before,))
+        nights = {}
+        for user_id, state in cursor.fetchall():
+            acc = json.loads(state)
+            acc['night'] = date.fromisoformat(acc['night'])
+            acc['last_seen'] = datetime.fromisoformat(acc['last_seen'])
+            nights[user_id] = acc
+        return nights
+    finally:
+        conn.close()
+
+def save_open_nights(nights):
+    """Persist accumulators so the next file (or run) continues them"""
+    rows = [(acc['user_id'], acc['night'], acc['closed'],
+             json.dumps(acc, default=lambda value: value.isoformat()))
+            for acc in nights]
+    if not rows:
+        return
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.executemany("""
+            REPLACE INTO device_open_nights (user_id, sleep_date, closed, state)
+            VALUES (%s, %s, %s, %s)
+        """, rows)
+        conn.commit()
+    except mysql.connector.Error:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def finish_night(acc):
+    """Turn a night's counters into a scored sleep entry"""
+    data = {
+        'sleep_hours': round(acc['asleep'] / 60, 1),
+        'disturbances': acc['disturbances'],
+        'temperature': (acc['temp_sum'] / acc['temp_count'] if acc['temp_count']
+                        else deviceDefaultTemperature),
+        'light_exposure': 'yes' if acc['lit'] >= deviceExposureMinutes else 'no',
+        'noise_level': 'yes' if acc['noisy'] >= deviceExposureMinutes else 'no'
+    }
+    return {'user_id': acc['user_id'], 'night': acc['night'], 'ended_at': acc['last_seen'],
+            'data': data, 'sleep_score': analyze_sleep(data)}
+
+def aggregate_nights(samples, report, open_nights, touched):
+    """Fold per-minute samples into scored nights, yielding each night once a later one starts.
+    
+    open_nights carries each user's accumulator across files (None once
+    looked up with nothing saved); users whose state changed are added to
+    touched. Nights still open at the end are closed by the caller.
+    """
+    for user_id, timestamp, movement, noise, light, temperature in samples:
+        if user_id not in open_nights:
+            open_nights[user_id] = load_open_nights([user_id]).get(user_id)
+        night = sleep_night(timestamp)
+        acc = open_nights[user_id]
+        if acc is not None and (night < acc['night'] or timestamp <= acc['last_seen']):
+            # Out of order or repeated minute for this user
+            report['rejected'] += 1
+            continue
+        if acc is not None and acc['closed'] and night == acc['night']:
+            # The night was already scored and stored
+            report['late'] += 1
+            continue
+        if acc is None or night > acc['night']:
+            if acc is not None and not acc['closed']:
+                yield from complete_night(acc, report)
+            acc = open_nights[user_id] = new_night(user_id, night)
+        touched.add(user_id)
+        
+        acc['minutes'] += 1
+        acc['last_seen'] = timestamp
+        if movement <= deviceSleepMovement:
+            acc['asleep'] += 1
+            acc['slept'] = True
+            acc['awake_run'] = 0
+        elif acc['slept']:
+            acc['awake_run'] += 1
+            if acc['awake_run'] == deviceWakeMinutes:
+                acc['disturbances'] += 1
+        acc['noisy'] += noise >= deviceNoiseDb
+        acc['lit'] += light >= deviceLightLux
+        if temperature is not None:
+            acc['temp_sum'] += temperature
+            acc['temp_count'] += 1
+
+def complete_night(acc, report):
+    acc['closed'] = True
+    if acc['minutes'] < deviceMinNightMinutes:
+        report['incomplete'] += 1
+        return
+    report['nights'] += 1
+    yield finish_night(acc)
+
+def chunked(iterable, size):
+    """Yield lists of up to size items"""
+    iterator = iter(iterable)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
+def write_device_nights(nights):
+    """Store a batch of device nights in one transaction; returns how many were new.
+    
+    Nights already stored for the user (replayed after a crash before the
+    open-night state was saved) are skipped.
+    Raises mysql.connector.Error so the caller can leave the file for a retry.
+    """
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor(dictionary=True)
+        user_ids = sorted({night['user_id'] for night in nights})
+        cursor.execute(f"""
+            SELECT user_id, sleep_date FROM sleep_records
+            WHERE submission_id = %s AND user_id IN ({', '.join(['%s'] * len(user_ids))})
+              AND sleep_date BETWEEN %s AND %s
+        """, [deviceSubmissionId] + user_ids +
+             [min(night['night'] for night in nights), max(night['night'] for night in nights)])
+        seen = {(row['user_id'], row['sleep_date']) for row in cursor.fetchall()}
+        
+        rows = []
+        for night in nights:
+            key = (night['user_id'], night['night'])
+            if key in seen:
+                continue
+            seen.add(key)
+            rows.append((night['user_id'],) + encode_sleep_record(night['data'], night['sleep_score']) +
+                        (night['night'], deviceSubmissionId, night['ended_at']))
+            update_user_stats(cursor, night['user_id'], night['data'], night['sleep_score'], night['night'])
+            record_cohort_sample(cursor, night['night'], night['data'], night['sleep_score'])
+        
+        if rows:
+            cursor.executemany("""
+                INSERT INTO sleep_records
+                (user_id, sleep_hours, disturbances, temperature, env_flags,
+                 sleep_score, sleep_date, submission_id, record_date)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """, rows)
+        conn.commit()
+    except mysql.connector.Error:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    
+    for user_id in {row[0] for row in rows}:
+        mark_recent_write(user_id)
+        sessions.invalidate(user_id)
+    return len(rows)
+
+def ingest_spool(spool_dir=None):
+    """Ingest the spool directory once; returns None if another process holds the ingest lock"""
+    spool_dir = spool_dir or ingestSpoolDir
+    try:
+        lock_conn = get_db_connection()
+        if not acquire_job_lock(lock_conn, "device-ingest"):
+            lock_conn.close()
+            print("⚠️ Device ingestion already running in another process")
+            return None
+    except mysql.connector.Error as err:
+        print(f"❌ Device ingestion skipped, database unavailable: {err}")
+        return None
+    try:
+        return ingest_spool_files(spool_dir)
+    finally:
+        lock_conn.close()
+
+def ingest_spool_files(spool_dir):
+    """Ingest every spool file once and report throughput.
+    
+    Ingested files move to done/ and unreadable ones to failed/; after a
+    database error the file stays in place and is retried on the next run.
+    """
+    report = {'files': 0, 'samples': 0, 'rejected': 0, 'late': 0, 'incomplete': 0,
+              'nights': 0, 'written': 0, 'duplicates': 0}
+    started = time.monotonic()
+    user_ids = {}
+    open_nights = {}
+    
+    os.makedirs(os.path.join(spool_dir, "done"), exist_ok=True)
+    os.makedirs(os.path.join(spool_dir, "failed"), exist_ok=True)
+    paths = sorted(entry.path for entry in os.scandir(spool_dir)
+                   if entry.is_file() and entry.name.endswith(('.csv', '.jsonl')))
+    
+    def write(nights):
+        for batch in chunked(nights, ingestBatchSize):
+            written = write_device_nights(batch)
+            report['written'] += written
+            report['duplicates'] += len(batch) - written
+    
+    for path in paths:
+        touched = set()
+        try:
+            samples = validate_samples(read_spool_file(path), report, user_ids)
+            write(aggregate_nights(samples, report, open_nights, touched))
+            save_open_nights(open_nights[user_id] for user_id in touched)
+        except mysql.connector.Error as err:
+            print(f"❌ Error ingesting {path}, will retry: {err}")
+            break
+        except (OSError, UnicodeDecodeError, csv.Error) as err:
+            print(f"❌ Unreadable spool file {path}: {err}")
+            # Forget the partial file's samples; saved state is reloaded on demand
+            for user_id in touched:
+                open_nights.pop(user_id, None)
+            os.replace(path, os.path.join(spool_dir, "failed", os.path.basename(path)))
+            continue
+        os.replace(path, os.path.join(spool_dir, "done", os.path.basename(path)))
+        report['files'] += 1
+    else:
+        # Score the nights no later file can still add to, including ones saved by earlier runs
+        try:
+            cutoff = sleep_night(datetime.now() - timedelta(hours=deviceLateHours))
+            for user_id, acc in load_open_nights(before=cutoff).items():
+                open_nights.setdefault(user_id, acc)
+            stale = [acc for acc in open_nights.values()
+                     if acc is not None and not acc['closed'] and acc['night'] < cutoff]
+            write(night for acc in stale for night in complete_night(acc, report))
+            save_open_nights(stale)
+        except mysql.connector.Error as err:
+            print(f"❌ Error closing device nights, will retry: {err}")
+    
+    elapsed = time.monotonic() - started
+    report['seconds'] = round(elapsed, 2)
+    report['samples_per_sec'] = round(report['samples'] / elapsed) if elapsed else 0
+    if paths or report['nights']:
+        print(f"✅ Ingested {report['files']} file(s): {report['samples']} samples "
+              f"({report['samples_per_sec']}/s), {report['rejected']} rejected, "
+              f"{report['late']} after their night closed, "
+              f"{report['nights']} nights ({report['incomplete']} incomplete dropped), "
+              f"{report['written']} new records ({report['duplicates']} already stored) "
+              f"in {report['seconds']}s")
+    return report
+
+def start_ingest_watcher():
+    """Ingest the spool directory every ingestPollSeconds"""
+    def loop():
+        while True:
+            try:
+                ingest_spool()
+            except Exception as err:  # A failed run must not stop the watcher
+                print(f"❌ Device ingestion failed: {err}")
+            time.sleep(ingestPollSeconds)
+    
+    thread = threading.Thread(target=loop, name="device-ingest", daemon=True)
+    thread.start()
+    return thread
+
+# =============================================
+# CHART DOWNSAMPLING
+# =============================================
+def lttb_indices(x, y, threshold):
+    """Indices picked by Largest-Triangle-Three-Buckets for threshold points"""
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    bucket_size = (n - 2) / (threshold - 2)
+    selected = [0]
+    a = 0
+    for i in range(threshold - 2):
+        # Average of the next bucket is the third triangle vertex
+        next_start = int((i + 1) * bucket_size) + 1
+        next_end = min(int((i + 2) * bucket_size) + 1, n)
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+        
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        areas = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) -
+                       (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(areas.argmax())
+        selected.append(a)
+    selected.append(n - 1)
+    return np.array(selected)
+
+def chart_point_budget(window_width, column_fraction=2 / 3):
+    """Points worth sending to a chart drawn in column_fraction of the window"""
+    if not window_width:
+        return historyRecordLimit
+    return max(chartMinPoints, int(window_width * column_fraction / chartPixelsPerPoint))
+
+def downsample_records(df, y_columns, budget):
+    """Reduce a date-sorted records frame to about budget rows for plotting.
+    
+    Each y column gets an equal share of the budget through LTTB, and its
+    minimum and maximum rows (the worst and best nights) are always kept.
+    """
+    if len(df) <= budget:
+        return df
+    
+    x = df['record_date'].astype('int64').to_numpy()
+    share = max(3, budget // len(y_columns))
+    keep = set()
+    for column in y_columns:
+        y = df[column].to_numpy(dtype=float)
+        keep.update(lttb_indices(x, y, share).tolist())
+        keep.update((int(y.argmin()), int(y.argmax())))
+    return df.iloc[sorted(keep)]
+
+# =============================================
+# TREND ENGINE
+# =============================================
+# Trends are computed on typed numpy columns rather than row dictionaries:
+# entries are averaged per night, rolling means use cumulative sums, and the
+# result is bucketed server-side so each figure carries a bounded number of points.
+ROLLING_WINDOWS = (7, 30)
+TREND_RANGES = (30, 90, 365)
+WEEKDAY_NAMES = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+CORRELATION_FACTORS = {
+    'sleep_hours': "Sleep hours",
+    'disturbances': "Disturbances",
+    'temperature_offset': "Distance from 21°C",
+    'light': "Light exposure",
+    'noise': "Noise"
+}
+
+def chart_window_start():
+    """First night the charts load: the longest trends range plus the rolling-average warm-up"""
+    return date.today() - timedelta(days=max(TREND_RANGES) + max(ROLLING_WINDOWS) - 1)
+
+def get_user_record_columns(user_id, since):
+    """A user's entries since a date as typed numpy columns"""
+    try:
+        conn = get_read_connection(user_id)
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT sleep_date, record_date, sleep_hours, sleep_score, disturbances, temperature, env_flags
+            FROM sleep_records
+            WHERE user_id = %s AND sleep_date >= %s
+        """, (user_id, since))
+        rows = cursor.fetchall()
+    except mysql.connector.Error as err:
+        print(f"❌ Error getting record columns: {err}")
+        rows = []
+    finally:
+        if 'conn' in locals() and conn.is_connected():
+            conn.close()
+    
+    dates, record_dates, hours, scores, disturbances, temperatures, flags = zip(*rows) if rows else ([],) * 7
+    flags = np.array(flags, dtype=np.uint8)
+    return {
+        'sleep_date': np.array(dates, dtype='datetime64[D]'),
+        'record_date': np.array(record_dates, dtype='datetime64[s]'),
+        'sleep_hours': np.array(hours, dtype=np.float32),
+        'sleep_score': np.array(scores, dtype=np.float32),
+        'disturbances': np.array(disturbances, dtype=np.float32),
+        'temperature': np.array(temperatures, dtype=np.float32),
+        'light': (flags & LIGHT_FLAG).astype(bool),
+        'noise': (flags & NOISE_FLAG).astype(bool)
+    }
+
+def nightly_means(day_index, values, days):
+    """Mean of values per day slot (NaN where a day has no entries), plus per-day counts"""
+    counts = np.bincount(day_index, minlength=days).astype(np.float64)
+    sums = np.bincount(day_index, weights=values, minlength=days)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts, counts
+
+def rolling_mean(daily, window):
+    """Trailing calendar-day mean that skips nights without entries"""
+    present = ~np.isnan(daily)
+    value_sums = np.concatenate(([0.0], np.cumsum(np.where(present, daily, 0.0))))
+    count_sums = np.concatenate(([0.0], np.cumsum(present)))
+    upper = np.arange(1, len(daily) + 1)
+    lower = np.maximum(upper - window, 0)
+    counts = count_sums[upper] - count_sums[lower]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, (value_sums[upper] - value_sums[lower]) / counts, np.nan)
+
+def select_nights(dates, daily, budget):
+    """Nights worth plotting from a daily series: LTTB plus its worst and best night"""
+    present = np.flatnonzero(~np.isnan(daily))
+    if len(present) > budget:
+        values = daily[present]
+        keep = set(present[lttb_indices(dates[present].astype(np.int64), values, budget)].tolist())
+        keep.update((int(present[values.argmin()]), int(present[values.argmax()])))
+        present = np.array(sorted(keep))
+    return dates[present], daily[present]
+
+def bucket_means(series, bucket):
+    """Average consecutive groups of bucket values, ignoring NaNs"""
+    if bucket <= 1:
+        return series
+    padded = np.full(-(-len(series) // bucket) * bucket, np.nan)
+    padded[:len(series)] = series
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanmean(padded.reshape(-1, bucket), axis=1)
+
+def compute_trends(columns, range_days, max_points, today=None):
+    """Rolling averages, weekday pattern and factor correlations for the selected range"""
+    today = np.datetime64(today or date.today(), 'D')
+    # Look back further than the range so the 30-day average is warm at its start
+    span = range_days + max(ROLLING_WINDOWS) - 1
+    first_day = today - np.timedelta64(span - 1, 'D')
+    in_span = columns['sleep_date'] >= first_day
+    day_index = (columns['sleep_date'][in_span] - first_day).astype(np.int64)
+    
+    score_daily, counts = nightly_means(day_index, columns['sleep_score'][in_span], span)
+    hours_daily, _ = nightly_means(day_index, columns['sleep_hours'][in_span], span)
+    
+    visible = slice(span - range_days, span)
+    days = np.arange(first_day, today + np.timedelta64(1, 'D'))[visible]
+    # Nightly values keep their extremes; the smooth averages are bucketed
+    series = {'Score': select_nights(days, score_daily[visible], max_points),
+              'Hours': select_nights(days, hours_daily[visible], max_points)}
+    bucket = max(1, -(-range_days // max_points))
+    for window in ROLLING_WINDOWS:
+        series[f'Score ({window}-day avg)'] = (
+            days[::bucket], bucket_means(rolling_mean(score_daily, window)[visible], bucket))
+        series[f'Hours ({window}-day avg)'] = (
+            days[::bucket], bucket_means(rolling_mean(hours_daily, window)[visible], bucket))
+    
+    # Weekday seasonality over entries in the visible range
+    in_range = columns['sleep_date'] >= today - np.timedelta64(range_days - 1, 'D')
+    scores = columns['sleep_score'][in_range].astype(np.float64)
+    # 1970-01-01 was a Thursday, so shift day numbers to make Monday 0
+    weekdays = (columns['sleep_date'][in_range].astype(np.int64) + 3) % 7
+    weekday_counts = np.bincount(weekdays, minlength=7)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weekday_scores = np.bincount(weekdays, weights=scores, minlength=7) / weekday_counts
+    
+    # Pearson correlation of each factor with score
+    factors = {
+        'sleep_hours': columns['sleep_hours'][in_range],
+        'disturbances': columns['disturbances'][in_range],
+        'temperature_offset': np.abs(columns['temperature'][in_range] - 21),
+        'light': columns['light'][in_range],
+        'noise': columns['noise'][in_range]
+    }
+    correlations = {}
+    for name, values in factors.items():
+        values = values.astype(np.float64)
+        if len(values) > 2 and values.std() > 0 and scores.std() > 0:
+            correlations[name] = float(np.corrcoef(values, scores)[0, 1])
+        else:
+            correlations[name] = None
+    
+    return {
+        'series': series,
+        'entries': int(in_range.sum()),
+        'weekday_scores': weekday_scores,
+        'weekday_counts': weekday_counts,
+        'correlations': correlations
+    }
+
+def build_trends_figure(trends, view):
+    """One compact figure for the requested trends view"""
+    fig = go.Figure()
+    if view == 'weekday':
+        fig.add_bar(
+            x=WEEKDAY_NAMES,
+            y=np.round(trends['weekday_scores'], 1),
+            customdata=trends['weekday_counts'],
+            hovertemplate="%{x}: %{y} avg score (%{customdata} entries)<extra></extra>",
+            marker_color='#2ca02c'
+        )
+        fig.update_layout(title="Average Sleep Score by Weekday", yaxis=dict(title='Sleep Score', range=[0, 100]))
+    elif view == 'factors':
+        names = [name for name, value in trends['correlations'].items() if value is not None]
+        values = [round(trends['correlations'][name], 2) for name in names]
+        fig.add_bar(
+            x=values,
+            y=[CORRELATION_FACTORS[name] for name in names],
+            orientation='h',
+            marker_color=['#2ca02c' if value > 0 else '#d62728' for value in values],
+            hovertemplate="%{y}: r = %{x}<extra></extra>"
+        )
+        fig.update_layout(title="What Moves Your Sleep Score (correlation)",
+                          xaxis=dict(title='Correlation with score', range=[-1, 1]))
+    else:
+        colors = {'Score': '#2ca02c', 'Hours': '#1f77b4'}
+        for name, (dates, values) in trends['series'].items():
+            metric = name.split()[0]
+            is_average = 'avg' in name
+            fig.add_scatter(
+                x=dates,
+                y=np.round(values, 2),
+                name=name,
+                mode='lines' if is_average else 'markers',
+                connectgaps=True,
+                yaxis='y2' if metric == 'Score' else 'y',
+                line=dict(color=colors[metric], dash='dot' if '30-day' in name else 'solid'),
+                marker=dict(color=colors[metric], size=4, opacity=0.4)
+            )
+        fig.update_layout(
+            title="Sleep Trends",
+            yaxis=dict(title='Sleep Hours', range=[0, 12]),
+            yaxis2=dict(title='Sleep Score', range=[0, 100], overlaying='y', side='right')
+        )
+    
+    fig.update_layout(
+        plot_bgcolor='rgba(0,0,0,0)',
+        paper_bgcolor='rgba(0,0,0,0)',
+        hovermode='x unified' if view == 'rolling' else 'closest',
+        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1)
+    )
+    return fig
+
 # =============================================
 # APP LAYOUT (IMPROVED)
 # =============================================
 app.layout = html.Div([
     dcc.Location(id='url', refresh=False),
     html.Div(id='page-content'),
-    dcc.Store(id='auth-status', storage_type='session', data='logged-out'),
-    dcc.Store(id='current-user', storage_type='session'),
+    dcc.Store(id='session-token', storage_type='session'),
+    dcc.Store(id='last-write', storage_type='session'),  # Client's last write time, for read-your-writes
     dcc.Store(id='sleep-data-store', storage_type='session')  # Store sleep data for callbacks
 ])
 
@@ -588,10 +2974,15 @@ login_layout = html.Div([
 ], style={'backgroundColor': '#f8f9fa', 'height': '100vh'})
 
 # Dashboard Layout
-def create_dashboard_layout(username):
-    user_id = get_user_id(username)
-    records = get_user_records(user_id)
-    latest_record = records[0] if records else None
+def create_dashboard_layout(session):
+    username = session['profile']['username']
+    is_admin = session['profile']['is_admin']
+    insights = session_insights(session)
+    if insights and insights['recommendations']:
+        insights_body = html.Ul([html.Li(rec) for rec in insights['recommendations']])
+    else:
+        insights_body = html.P("Personalized insights are generated nightly once you have a few entries.",
+                               className="text-muted mb-0")
     
     return html.Div([
         # Navigation Bar
@@ -608,6 +2999,8 @@ def create_dashboard_layout(username):
                     dbc.NavItem(dbc.NavLink("New Entry", href="#new-entry")),
                     dbc.NavItem(dbc.NavLink("History", href="#history")),
                     dbc.NavItem(dbc.NavLink("Trends", href="#trends")),
+                    dbc.NavItem(dbc.NavLink("Analytics", href="/admin/analytics"))
+                    if is_admin else None,
                     dbc.NavItem(dbc.NavLink(f"Welcome, {username}", disabled=True)),
                     dbc.NavItem(dbc.NavLink("Logout", id="logout-link", href="/logout")),
                 ], className="ml-auto", navbar=True)
@@ -683,6 +3076,8 @@ def create_dashboard_layout(username):
                                 
                                 dbc.Button("Submit", id="submit-button", 
                                           color="primary", className="w-100"),
+                                dcc.Store(id="pending-sleep-record"),
+                                dcc.Store(id="chart-width"),
                             ]),
                         ]),
                     ], className="mb-4"),
@@ -705,6 +3100,27 @@ def create_dashboard_layout(username):
                                          style={"flex": "1"}),
                                 dbc.Button("Send", id="chat-send", color="primary"),
                             ], style={"width": "100%"}),
+                            
+                            # Search past conversations
+                            html.Hr(),
+                            dbc.InputGroup([
+                                dbc.Input(id="chat-search-input", placeholder="Search past conversations...",
+                                         type="text", style={"flex": "1"}),
+                                dbc.Button("Search", id="chat-search-button", color="secondary"),
+                            ], style={"width": "100%"}, className="mb-2"),
+                            dbc.Checklist(
+                                id="chat-search-all-users",
+                                options=[{"label": "Search all users", "value": "all"}],
+                                value=[],
+                                switch=True,
+                                className="mb-2",
+                                # Only support staff (admins) may widen the scope
+                                style={} if is_admin else {"display": "none"}
+                            ),
+                            html.Div(id="chat-search-results"),
+                            dbc.Pagination(id="chat-search-pages", max_value=1, active_page=1,
+                                           fully_expanded=False, size="sm", className="mt-2",
+                                           style={"display": "none"}),
                         ]),
                     ]),
                 ], md=4),
@@ -717,13 +3133,21 @@ def create_dashboard_layout(username):
                         dbc.CardBody([
                             html.Div(id="sleep-score-display", className="text-center"),
                             html.Div(id="recommendations", className="mt-3"),
+                            html.Div(id="baseline-notes"),
                         ]),
                     ], className="mb-4"),
                     
+                    # Nightly Insights Card
+                    dbc.Card([
+                        dbc.CardHeader("Your Sleep Insights", className="bg-secondary text-white"),
+                        dbc.CardBody(insights_body),
+                    ], className="mb-4"),
+                    
                     # Sleep History Card
                     dbc.Card([
                         dbc.CardHeader("Sleep History", className="bg-info text-white"),
                         dbc.CardBody([
+                            html.Small(id="sleep-history-status", className="text-muted"),
                             dcc.Graph(id="sleep-history-chart"),
                         ]),
                     ]),
@@ -732,6 +3156,26 @@ def create_dashboard_layout(username):
                     dbc.Card([
                         dbc.CardHeader("Sleep Trends", className="bg-warning text-white"),
                         dbc.CardBody([
+                            dbc.Row([
+                                dbc.Col(dbc.RadioItems(
+                                    id="trends-view",
+                                    options=[
+                                        {"label": "Rolling averages", "value": "rolling"},
+                                        {"label": "Weekday pattern", "value": "weekday"},
+                                        {"label": "Factor impact", "value": "factors"},
+                                    ],
+                                    value="rolling",
+                                    inline=True,
+                                ), md=8),
+                                dbc.Col(dbc.Select(
+                                    id="trends-range",
+                                    options=[{"label": f"Last {days} days", "value": days}
+                                             for days in TREND_RANGES],
+                                    value=90,
+                                    size="sm",
+                                ), md=4),
+                            ], className="mb-2"),
+                            html.Small(id="sleep-trends-status", className="text-muted"),
                             dcc.Graph(id="sleep-trends-chart"),
                         ]),
                     ], className="mt-4"),
@@ -740,34 +3184,206 @@ def create_dashboard_layout(username):
         ], fluid=True, className="mt-3"),
     ])
 
+# Admin Analytics Layout
+def create_analytics_layout(session):
+    username = session['profile']['username']
+    return html.Div([
+        dbc.Navbar(
+            [
+                dbc.NavbarBrand("Cohort Analytics"),
+                dbc.Nav([
+                    dbc.NavItem(dbc.NavLink("Dashboard", href="/dashboard")),
+                    dbc.NavItem(dbc.NavLink(f"Welcome, {username}", disabled=True)),
+                    dbc.NavItem(dbc.NavLink("Logout", href="/logout")),
+                ], className="ml-auto", navbar=True)
+            ],
+            color="dark",
+            dark=True,
+            sticky="top"
+        ),
+        
+        dbc.Container([
+            dbc.Row([
+                dbc.Col([
+                    dbc.Label("Date Range"),
+                    dcc.Dropdown(
+                        id="cohort-range",
+                        options=[
+                            {"label": "Last 7 days", "value": 7},
+                            {"label": "Last 30 days", "value": 30},
+                            {"label": "Last 90 days", "value": 90},
+                            {"label": "Last 365 days", "value": 365},
+                        ],
+                        value=30,
+                        clearable=False
+                    ),
+                ], md=4),
+            ], className="mb-4"),
+            
+            dbc.Card([
+                dbc.CardHeader("Population Percentiles", className="bg-primary text-white"),
+                dbc.CardBody(html.Div(id="cohort-percentiles")),
+            ], className="mb-4"),
+            
+            dbc.Row([
+                dbc.Col(dbc.Card([
+                    dbc.CardHeader("Sleep Score Distribution", className="bg-success text-white"),
+                    dbc.CardBody(dcc.Graph(id="cohort-score-histogram")),
+                ]), md=6),
+                dbc.Col(dbc.Card([
+                    dbc.CardHeader("Sleep Hours Distribution", className="bg-info text-white"),
+                    dbc.CardBody(dcc.Graph(id="cohort-hours-histogram")),
+                ]), md=6),
+            ], className="mb-4"),
+            
+            dbc.Card([
+                dbc.CardHeader("Daily Sleep Score Bands", className="bg-warning text-white"),
+                dbc.CardBody(dcc.Graph(id="cohort-daily-bands")),
+            ]),
+        ], fluid=True, className="mt-3"),
+    ])
+
+# =============================================
+# ASYNC EXECUTION
+# =============================================
+# In async mode the I/O-bound callbacks become coroutines that hand their
+# blocking mysql.connector work to a bounded thread pool, so waiting on the
+# database never holds the event loop and DB concurrency is capped at
+# dbPoolSize. This only multiplexes requests under an ASGI server; under
+# Flask/WSGI Dash runs each coroutine to completion in the request thread.
+# Sync mode (the default) registers the plain functions.
+db_executor = ThreadPoolExecutor(max_workers=dbPoolSize, thread_name_prefix="db")
+
+async def run_blocking(fn, *args):
+    """Run fn in the DB pool, keeping contextvars such as dash.callback_context"""
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(db_executor, functools.partial(context.run, fn, *args))
+
+def offload(fn):
+    """fn as a coroutine that runs it in the DB pool"""
+    @functools.wraps(fn)
+    async def async_callback(*args):
+        return await run_blocking(fn, *args)
+    return async_callback
+
+def io_bound(enabled=True):
+    """Register the decorated callback as an offloaded coroutine in async mode"""
+    def decorator(fn):
+        if not (use_async_callbacks and enabled):
+            return fn
+        return offload(fn)
+    return decorator
+
+def after_client_write(fn):
+    """Route the callback's reads by its trailing State('last-write') argument.
+    
+    The value is the client's last write time; while it is recent, reads go
+    to the primary and older session-cache entries are reloaded.
+    """
+    @functools.wraps(fn)
+    def wrapper(*args):
+        last_write = args[-1] if isinstance(args[-1], (int, float)) else None
+        token = client_last_write.set(last_write)
+        try:
+            return fn(*args[:-1])
+        finally:
+            client_last_write.reset(token)
+    return wrapper
+
+def benchmark_execution_modes(sessions=500, db_calls=3, db_latency=0.02, use_database=False):
+    """Compare sync and async callback execution as each mode is deployed.
+    
+    Each session runs a callback wrapped like the real ones (after_client_write)
+    that makes db_calls blocking queries of db_latency seconds: SELECT SLEEP
+    on the read connection with use_database, time.sleep otherwise. Sync mode
+    calls it on syncWorkerThreads request threads, as a threaded WSGI worker
+    does. Async mode awaits the io_bound coroutine for every session on one
+    event loop, as an ASGI worker does, so the work goes through run_blocking
+    and db_executor (dbPoolSize threads) with its context copy and loop hops.
+    Returns throughput and p95 latency per mode.
+    """
+    def query():
+        if not use_database:
+            time.sleep(db_latency)  # Stand-in for one MySQL round trip
+            return
+        conn = get_read_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT SLEEP(%s)", (db_latency,))
+            cursor.fetchall()
+        finally:
+            conn.close()
+    
+    @after_client_write
+    def callback_handler(started):
+        for _ in range(db_calls):
+            query()
+        return time.perf_counter() - started
+    
+    async_handler = offload(callback_handler)
+    
+    async def run_async():
+        started = time.perf_counter()
+        return await asyncio.gather(*(async_handler(started, None) for _ in range(sessions)))
+    
+    results = {}
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=syncWorkerThreads) as request_threads:
+        latencies = list(request_threads.map(lambda _: callback_handler(started, None), range(sessions)))
+    results[f'sync ({syncWorkerThreads} request threads)'] = ('sync', time.perf_counter() - started, latencies)
+    
+    started = time.perf_counter()
+    latencies = asyncio.run(run_async())
+    results[f'async (1 event loop, {dbPoolSize} DB threads)'] = ('async', time.perf_counter() - started, latencies)
+    
+    report = {}
+    for label, (mode, elapsed, latencies) in results.items():
+        report[mode] = {
+            'sessions_per_sec': round(sessions / elapsed, 1),
+            'p95_latency_ms': round(statistics.quantiles(latencies, n=20)[-1] * 1000, 1)
+        }
+        print(f"{label}: {report[mode]['sessions_per_sec']} sessions/s, "
+              f"p95 {report[mode]['p95_latency_ms']} ms")
+    return report
+
 # =============================================
 # CALLBACKS (IMPROVED)
 # =============================================
 # Route between login and dashboard
 @callback(
     Output('page-content', 'children'),
-    Output('auth-status', 'data', allow_duplicate=True),
-    Output('current-user', 'data', allow_duplicate=True),
+    Output('session-token', 'data', allow_duplicate=True),
     Input('url', 'pathname'),
-    State('auth-status', 'data'),
-    State('current-user', 'data'),
+    State('session-token', 'data'),
+    State('last-write', 'data'),
     prevent_initial_call=True
 )
-def display_page(pathname, auth_status, current_user):
+@after_client_write
+def display_page(pathname, token):
     if pathname == '/logout':
-        return login_layout, 'logged-out', None
+        sessions.revoke(token)
+        return login_layout, None
     
-    if pathname == '/dashboard' or auth_status == 'logged-in':
-        if current_user:
-            return create_dashboard_layout(current_user), 'logged-in', current_user
+    # A missing, forged or expired token is cleared and sent to login
+    session = sessions.get(token)
+    if session is None:
+        return login_layout, None
     
-    return login_layout, 'logged-out', None
+    if pathname == '/admin/analytics' and user_is_admin(session['profile']['id']):
+        return create_analytics_layout(session), no_update
+    
+    return create_dashboard_layout(session), no_update
+
+def start_session(username):
+    """Create a server-side session for an authenticated user; returns its token"""
+    profile = get_user_profile(username)
+    return sessions.create(profile) if profile else None
 
 # Handle authentication (login/signup)
 @callback(
     Output('url', 'pathname', allow_duplicate=True),
-    Output('auth-status', 'data', allow_duplicate=True),
-    Output('current-user', 'data', allow_duplicate=True),
+    Output('session-token', 'data', allow_duplicate=True),
     Output('login-feedback', 'children'),
     Output('signup-feedback', 'children'),
     Input('login-button', 'n_clicks'),
@@ -780,155 +3396,249 @@ def display_page(pathname, auth_status, current_user):
     State('signup-confirm', 'value'),
     prevent_initial_call=True
 )
+@io_bound()
 def handle_auth(login_clicks, signup_clicks, login_user, login_pass, 
                signup_user, signup_pass, signup_email, signup_confirm):
     ctx = dash.callback_context
     if not ctx.triggered:
-        return no_update, no_update, no_update, no_update, no_update
+        return no_update, no_update, no_update, no_update
     
     trigger_id = ctx.triggered[0]['prop_id'].split('.')[0]
     
     if trigger_id == 'login-button':
         if not login_user or not login_pass:
-            return no_update, no_update, no_update, dbc.Alert("Please enter both username and password", color="danger"), no_update
+            return no_update, no_update, dbc.Alert("Please enter both username and password", color="danger"), no_update
         
         if verify_user(login_user, login_pass):
-            return '/dashboard', 'logged-in', login_user, no_update, no_update
+            return '/dashboard', start_session(login_user), no_update, no_update
         else:
-            return no_update, no_update, no_update, dbc.Alert("Invalid username or password", color="danger"), no_update
+            return no_update, no_update, dbc.Alert("Invalid username or password", color="danger"), no_update
     
     elif trigger_id == 'signup-button':
         if not signup_user or not signup_pass:
-            return no_update, no_update, no_update, no_update, dbc.Alert("Username and password are required", color="danger")
+            return no_update, no_update, no_update, dbc.Alert("Username and password are required", color="danger")
+        
+        if signup_user.lower() in reservedUsernames:
+            return no_update, no_update, no_update, dbc.Alert("This username is reserved", color="danger")
         
         if len(signup_pass) < 8:
-            return no_update, no_update, no_update, no_update, dbc.Alert("Password must be at least 8 characters", color="danger")
+            return no_update, no_update, no_update, dbc.Alert("Password must be at least 8 characters", color="danger")
         
         if signup_pass != signup_confirm:
-            return no_update, no_update, no_update, no_update, dbc.Alert("Passwords do not match", color="danger")
+            return no_update, no_update, no_update, dbc.Alert("Passwords do not match", color="danger")
         
         if create_user(signup_user, signup_pass, signup_email):
-            return '/dashboard', 'logged-in', signup_user, no_update, no_update
+            return '/dashboard', start_session(signup_user), no_update, no_update
         else:
-            return no_update, no_update, no_update, no_update, dbc.Alert("Username already exists", color="danger")
+            return no_update, no_update, no_update, dbc.Alert("Username already exists", color="danger")
     
-    return no_update, no_update, no_update, no_update, no_update
+    return no_update, no_update, no_update, no_update
 
-# Handle sleep data submission
-@callback(
+# Score and render the new entry in the browser (mirrors parse_sleep_entry
+# and analyze_sleep), handing only the validated record to the server for
+# persistence; the previous entry's baseline notes are cleared meanwhile
+clientside_callback(
+    """
+    function(n_clicks, hours, disturbances, temp, light, noise, pending) {
+        const noUpdate = window.dash_clientside.no_update;
+        const el = (type, props, namespace) => ({
+            type: type,
+            namespace: namespace || 'dash_html_components',
+            props: props
+        });
+        const alert = (children, color) => el('Alert', {children: children, color: color},
+                                              'dash_bootstrap_components');
+        
+        if ([hours, disturbances, temp, light, noise].some(v => v === null || v === undefined || v === '')) {
+            return ["", alert("Please fill all fields", "danger"), null, noUpdate];
+        }
+        const data = {
+            sleep_hours: parseFloat(hours),
+            disturbances: parseInt(disturbances, 10),
+            temperature: parseFloat(temp),
+            light_exposure: light,
+            noise_level: noise
+        };
+        if ([data.sleep_hours, data.disturbances, data.temperature].some(isNaN) ||
+                data.sleep_hours < 0 || data.sleep_hours > 24 || data.disturbances < 0) {
+            return ["", alert("Please enter valid numbers", "danger"), null, noUpdate];
+        }
+        
+        let score = 100;
+        if (data.sleep_hours < 6) {
+            score -= 30;
+        } else if (data.sleep_hours < 7) {
+            score -= 15;
+        }
+        if (data.disturbances > 2) {
+            score -= data.disturbances * 5;
+        }
+        if (data.temperature < 18 || data.temperature > 24) {
+            score -= 10;
+        }
+        if (data.light_exposure === 'yes') {
+            score -= 20;
+        }
+        if (data.noise_level === 'yes') {
+            score -= 15;
+        }
+        score = Math.max(score, 0);
+        
+        // Repeated clicks on an unchanged form are dropped before reaching the server
+        const fields = ['sleep_hours', 'disturbances', 'temperature', 'light_exposure', 'noise_level'];
+        const now = Date.now();
+        if (pending && fields.every(f => pending[f] === data[f]) &&
+                now - pending.submitted_at < DUPLICATE_WINDOW_MS) {
+            return [noUpdate, noUpdate, noUpdate, noUpdate];
+        }
+        
+        const gauge = el('Gauge', {
+            id: 'sleep-score-gauge',
+            label: 'Sleep Score',
+            value: score,
+            min: 0,
+            max: 100,
+            color: {gradient: true, ranges: {red: [0, 50], yellow: [50, 80], green: [80, 100]}},
+            size: 200,
+            className: 'mb-3'
+        }, 'dash_daq');
+        
+        const tier = (heading, intro, items, color) => alert([
+            el('H4', {children: heading, className: 'alert-heading'}),
+            el('P', {children: intro}),
+            items.length ? el('Ul', {children: items.map(item => el('Li', {children: item}))}) : null
+        ].filter(Boolean), color);
+        let rec;
+        if (score > 80) {
+            rec = tier("Excellent Sleep Quality",
+                       "Keep up the good habits! Your sleep environment and duration are optimal.",
+                       [], "success");
+        } else if (score > 50) {
+            rec = tier("Moderate Sleep Quality", "Consider these improvements:", [
+                "Aim for 7-9 hours of sleep",
+                "Reduce disturbances in your sleep environment",
+                "Maintain room temperature between 18-24°C",
+                "Minimize light and noise exposure"
+            ], "warning");
+        } else {
+            rec = tier("Poor Sleep Quality", "Immediate improvements needed:", [
+                "Increase sleep duration to at least 7 hours",
+                "Identify and eliminate disturbance sources",
+                "Adjust room temperature to optimal range",
+                "Use blackout curtains and white noise if needed",
+                "Consider a consistent bedtime routine"
+            ], "danger");
+        }
+        
+        // Idempotency key: the server saves each submission_id at most once
+        const submissionId = now.toString(36) + '-' + Math.random().toString(36).slice(2, 10);
+        return [gauge, rec, null, Object.assign({submitted_at: now, submission_id: submissionId}, data)];
+    }
+    """.replace("DUPLICATE_WINDOW_MS", str(duplicateSubmitWindow * 1000)),
     Output('sleep-score-display', 'children'),
     Output('recommendations', 'children'),
-    Output('sleep-data-store', 'data'),
+    Output('baseline-notes', 'children', allow_duplicate=True),
+    Output('pending-sleep-record', 'data'),
     Input('submit-button', 'n_clicks'),
     State('sleep-hours', 'value'),
     State('disturbances', 'value'),
     State('temperature', 'value'),
     State('light-exposure', 'value'),
     State('noise-level', 'value'),
-    State('current-user', 'data'),
+    State('pending-sleep-record', 'data'),
     prevent_initial_call=True
 )
-def analyze_and_display(n_clicks, hours, disturbances, temp, light, noise, username):
-    if None in [hours, disturbances, temp, light, noise]:
-        return "", dbc.Alert("Please fill all fields", color="danger"), no_update
+
+# Persist the validated sleep entry
+@callback(
+    Output('sleep-data-store', 'data'),
+    Output('baseline-notes', 'children'),
+    Output('last-write', 'data', allow_duplicate=True),
+    Output('pending-sleep-record', 'data', allow_duplicate=True),
+    Input('pending-sleep-record', 'data'),
+    State('session-token', 'data'),
+    prevent_initial_call=True
+)
+@io_bound()
+def save_sleep_entry(record, token):
+    session = sessions.get(token)
+    if not record or session is None:
+        return no_update, no_update, no_update, no_update
     
+    # A rejected entry is cleared from pending-sleep-record so the browser's
+    # duplicate-click check lets an identical retry through
     try:
-        data = {
-            'sleep_hours': float(hours),
-            'disturbances': int(disturbances),
-            'temperature': float(temp),
-            'light_exposure': light,
-            'noise_level': noise
-        }
-        
+        data = parse_sleep_entry(record)
+        submission_id = str(record.get('submission_id') or '')[:64] or None
+    except (KeyError, TypeError, ValueError):
+        return no_update, dbc.Alert("Please enter valid numbers", color="danger"), no_update, None
+    
+    def persist():
+        # Re-score on the server so stored scores never depend on the client
         score = analyze_sleep(data)
-        user_id = get_user_id(username)
-        if user_id:
-            save_sleep_record(user_id, data, score)
+        # Baseline is read before saving so the entry is compared to prior nights
+        user_stats = session_stats(session)
+        saved = save_sleep_record(session['profile']['id'], data, score, submission_id)
         
-        # Add score to data for chatbot
+        # Add score to data for chatbot; saved_at makes each save a distinct chart job
         sleep_data = data.copy()
         sleep_data['sleep_score'] = score
-        
-        # Create gauge
-        gauge = daq.Gauge(
-            id='sleep-score-gauge',
-            label="Sleep Score",
-            value=score,
-            min=0,
-            max=100,
-            color={
-                "gradient": True,
-                "ranges": {
-                    "red": [0, 50],
-                    "yellow": [50, 80],
-                    "green": [80, 100]
-                }
-            },
-            size=200,
-            className="mb-3"
-        )
-        
-        # Create recommendations
-        if score > 80:
-            rec = dbc.Alert([
-                html.H4("Excellent Sleep Quality", className="alert-heading"),
-                html.P("Keep up the good habits! Your sleep environment and duration are optimal."),
-            ], color="success")
-        elif score > 50:
-            rec = dbc.Alert([
-                html.H4("Moderate Sleep Quality", className="alert-heading"),
-                html.P("Consider these improvements:"),
-                html.Ul([
-                    html.Li("Aim for 7-9 hours of sleep"),
-                    html.Li("Reduce disturbances in your sleep environment"),
-                    html.Li("Maintain room temperature between 18-24°C"),
-                    html.Li("Minimize light and noise exposure")
-                ])
-            ], color="warning")
-        else:
-            rec = dbc.Alert([
-                html.H4("Poor Sleep Quality", className="alert-heading"),
-                html.P("Immediate improvements needed:"),
-                html.Ul([
-                    html.Li("Increase sleep duration to at least 7 hours"),
-                    html.Li("Identify and eliminate disturbance sources"),
-                    html.Li("Adjust room temperature to optimal range"),
-                    html.Li("Use blackout curtains and white noise if needed"),
-                    html.Li("Consider a consistent bedtime routine")
-                ])
-            ], color="danger")
-        
-        return gauge, rec, sleep_data
-    
-    except ValueError:
-        return "", dbc.Alert("Please enter valid numbers", color="danger"), no_update
+        sleep_data['saved_at'] = time.time()
+        # Keep the pre-save baseline with the entry so the chatbot compares against the same one
+        sleep_data['baseline'] = baseline_snapshot(user_stats)
+        return sleep_data, compare_to_baseline(user_stats, sleep_data), saved
+    
+    if submission_id:
+        result, shared = submission_flight.do((session['profile']['id'], submission_id), persist)
+    else:
+        result, shared = persist(), False
+    
+    # A coalesced or already-stored duplicate must not refresh the charts again
+    if shared or result is None or result[2] is False:
+        return no_update, no_update, no_update, no_update
+    if result[2] is None:
+        return no_update, dbc.Alert("Your entry could not be saved, please try again",
+                                    color="danger"), no_update, None
+    
+    sleep_data, baseline_notes, _ = result
+    if not baseline_notes:
+        return sleep_data, None, sleep_data['saved_at'], no_update
+    
+    return sleep_data, dbc.Alert([
+        html.H5("Compared to Your History", className="alert-heading"),
+        html.Ul([html.Li(note) for note in baseline_notes])
+    ], color="info"), sleep_data['saved_at'], no_update
 
 # Chatbot interaction (FIXED)
 # Chatbot interaction (FIXED)
 @callback(
     Output('chat-messages', 'children'),
     Output('chat-input', 'value'),
+    Output('last-write', 'data', allow_duplicate=True),
     Input('chat-send', 'n_clicks'),
     State('chat-input', 'value'),
-    State('current-user', 'data'),
+    State('session-token', 'data'),
     State('sleep-data-store', 'data'),
     State('chat-messages', 'children'),
+    State('last-write', 'data'),
     prevent_initial_call=True
 )
-def handle_chat(n_clicks, message, username, sleep_data, current_messages):
-    if not message or not username:
-        return no_update, ""
-    
-    # Get user ID
-    user_id = get_user_id(username)
+@io_bound()
+@after_client_write
+def handle_chat(n_clicks, message, token, sleep_data, current_messages):
+    session = sessions.get(token)
+    if not message or session is None:
+        return no_update, "", no_update
     
     # Generate response
-    response = get_chatbot_response(message, username, sleep_data)
+    profile = session['profile']
+    # The latest entry is already in the stored stats, so analyze it against its pre-save baseline
+    user_stats = sleep_data.get('baseline') if sleep_data else session_stats(session)
+    response = get_chatbot_response(message, profile['username'], sleep_data,
+                                    user_stats, session_insights(session))
     
     # Save conversation
-    if user_id:
-        save_chat_message(user_id, message, response)
+    save_chat_message(profile['id'], message, response)
     
     # Create message bubbles
     user_bubble = dbc.Card([
@@ -957,28 +3667,115 @@ def handle_chat(n_clicks, message, username, sleep_data, current_messages):
     
     new_messages = current_messages + [user_bubble, bot_bubble]
     
-    return new_messages, ""
+    return new_messages, "", time.time()
+
+def chart_callback_options(prefix):
+    """Callback options shared by the chart callbacks.
+    
+    While a chart is recomputed it is dimmed with a status note. With a
+    background manager (backgroundCharts) the work runs as a cached background
+    job in its own process that a new submission cancels; identical (session,
+    saved entry, view) jobs reuse the cached figure. Cancelling on the validated record rather than raw clicks
+    keeps a deduplicated repeat click from cancelling the job it duplicates.
+    """
+    options = {
+        'running': [
+            (Output(f'{prefix}-chart', 'style'), {'opacity': 0.4}, {'opacity': 1}),
+            (Output(f'{prefix}-status', 'children'), "Updating chart...", ""),
+        ]
+    }
+    if background_callback_manager is not None:
+        options.update(
+            background=True,
+            cancel=[Input('pending-sleep-record', 'data')]
+        )
+    return options
+
+# Report the browser width once so chart callbacks can size their point budget
+clientside_callback(
+    """
+    function(_) {
+        return window.innerWidth;
+    }
+    """,
+    Output('chart-width', 'data'),
+    Input('chart-width', 'id'),
+)
+
+# Search past conversations
+@callback(
+    Output('chat-search-results', 'children'),
+    Output('chat-search-pages', 'max_value'),
+    Output('chat-search-pages', 'active_page'),
+    Output('chat-search-pages', 'style'),
+    Input('chat-search-button', 'n_clicks'),
+    Input('chat-search-pages', 'active_page'),
+    State('chat-search-input', 'value'),
+    State('chat-search-all-users', 'value'),
+    State('session-token', 'data'),
+    State('last-write', 'data'),
+    prevent_initial_call=True
+)
+@io_bound()
+@after_client_write
+def search_chats(n_clicks, active_page, query, all_users, token):
+    session = sessions.get(token)
+    if not query or session is None:
+        return None, 1, 1, {"display": "none"}
+    
+    # A new search always starts on the first page
+    page = 1 if dash.callback_context.triggered_id == 'chat-search-button' else (active_page or 1)
+    user_id = session['profile']['id']
+    if all_users and 'all' in all_users and user_is_admin(user_id):
+        user_id = None
+    
+    results, total = search_conversations(user_id, query, page)
+    if not total:
+        return html.P("No matching conversations", className="text-muted"), 1, 1, {"display": "none"}
+    
+    terms = tokenize(query)
+    items = []
+    for result in results:
+        owner = f" · user #{result['user_id']}" if user_id is None else ""
+        items.append(dbc.ListGroupItem([
+            html.Small(f"{result['timestamp']:%Y-%m-%d %H:%M}{owner}", className="text-muted"),
+            html.P([html.B("You: ")] + highlight_snippet(result['message'], terms), className="mb-1"),
+            html.P([html.B("Assistant: ")] + highlight_snippet(result['response'], terms), className="mb-0"),
+        ]))
+    
+    pages = -(-total // searchPageSize)
+    summary = html.Small(f"{total} matching conversation{'s' if total != 1 else ''}", className="text-muted")
+    return ([summary, dbc.ListGroup(items, className="mt-1")], pages, page,
+            {"display": "flex"} if pages > 1 else {"display": "none"})
 
 # Update history chart (IMPROVED)
 @callback(
     Output('sleep-history-chart', 'figure'),
-    Input('submit-button', 'n_clicks'),
     Input('sleep-data-store', 'data'),
-    State('current-user', 'data'),
+    Input('chart-width', 'data'),
+    State('session-token', 'data'),
+    State('last-write', 'data'),
+    **chart_callback_options('sleep-history')
 )
-def update_history(n_clicks, sleep_data, username):
-    user_id = get_user_id(username)
-    records = get_user_records(user_id, limit=30)  # Get last 30 records
+# Background jobs already run outside the request, so they stay synchronous
+@io_bound(enabled=background_callback_manager is None)
+@after_client_write
+def update_history(sleep_data, chart_width, token):
+    session = sessions.get(token)
+    columns = session_record_columns(session) if session else None
     
-    if not records:
+    if columns is None or not len(columns['record_date']):
         return px.bar(title="No sleep records yet").update_layout(
             plot_bgcolor='rgba(0,0,0,0)',
             paper_bgcolor='rgba(0,0,0,0)'
         )
     
-    df = pd.DataFrame(records)
-    df['record_date'] = pd.to_datetime(df['record_date'])
-    df = df.sort_values('record_date')
+    # Same coalesced read as the trends chart; the latest historyRecordLimit entries are shown
+    df = pd.DataFrame({name: columns[name] for name in
+                       ('record_date', 'sleep_score', 'sleep_hours', 'disturbances', 'temperature')})
+    df[['sleep_hours', 'temperature']] = df[['sleep_hours', 'temperature']].astype(float).round(1)
+    df = df.sort_values('record_date').tail(historyRecordLimit)
+    df = downsample_records(df, ['sleep_score'], chart_point_budget(chart_width))
     
     fig = px.bar(
         df,
@@ -1004,63 +3801,336 @@ def update_history(n_clicks, sleep_data, username):
 # Update trends chart (IMPROVED)
 @callback(
     Output('sleep-trends-chart', 'figure'),
-    Input('submit-button', 'n_clicks'),
     Input('sleep-data-store', 'data'),
-    State('current-user', 'data'),
+    Input('chart-width', 'data'),
+    Input('trends-range', 'value'),
+    Input('trends-view', 'value'),
+    State('session-token', 'data'),
+    State('last-write', 'data'),
+    **chart_callback_options('sleep-trends')
 )
-def update_trends(n_clicks, sleep_data, username):
-    user_id = get_user_id(username)
-    records = get_user_records(user_id, limit=30)  # Get last 30 records
+# Background jobs already run outside the request, so they stay synchronous
+@io_bound(enabled=background_callback_manager is None)
+@after_client_write
+def update_trends(sleep_data, chart_width, range_days, view, token):
+    session = sessions.get(token)
+    range_days = int(range_days or 90)
+    columns = session_record_columns(session) if session else None
+    trends = compute_trends(columns, range_days, chart_point_budget(chart_width)) if columns else None
     
-    if not records or len(records) < 2:
+    if trends is None or trends['entries'] < 2:
         return px.line(title="Not enough data for trends").update_layout(
             plot_bgcolor='rgba(0,0,0,0)',
             paper_bgcolor='rgba(0,0,0,0)'
         )
     
-    df = pd.DataFrame(records)
-    df['record_date'] = pd.to_datetime(df['record_date'])
-    df = df.sort_values('record_date')
+    return build_trends_figure(trends, view)
+
+# Cohort analytics (admin only)
+@callback(
+    Output('cohort-percentiles', 'children'),
+    Output('cohort-score-histogram', 'figure'),
+    Output('cohort-hours-histogram', 'figure'),
+    Output('cohort-daily-bands', 'figure'),
+    Input('cohort-range', 'value'),
+    State('session-token', 'data'),
+)
+def update_cohort_analytics(range_days, token):
+    session = sessions.get(token)
+    if session is None or not user_is_admin(session['profile']['id']):
+        return dbc.Alert("Admin access required", color="danger"), no_update, no_update, no_update
     
-    # Create figure with secondary y-axis
-    fig = px.line(
-        df,
-        x='record_date',
-        y=['sleep_hours'],
-        title="Sleep Trends",
-        labels={'value': 'Hours', 'record_date': 'Date', 'variable': 'Metric'},
-        color_discrete_map={
-            'sleep_hours': '#1f77b4'
-        }
-    )
+    end_date = date.today()
+    start_date = end_date - timedelta(days=int(range_days) - 1)
+    merged = get_cohort_histograms(start_date, end_date)
+    daily = get_cohort_histograms(start_date, end_date, by_day=True)
     
-    # Add sleep score as a separate trace
-    fig.add_trace(px.line(
-        df,
-        x='record_date',
-        y=['sleep_score'],
-        color_discrete_map={
-            'sleep_score': '#2ca02c'
-        }
-    ).data[0])
+    # Percentile table
+    header = html.Thead(html.Tr([html.Th("Metric"), html.Th("Entries")] +
+                                [html.Th(f"P{p}") for p in cohortPercentiles]))
+    rows = []
+    for metric, info in COHORT_METRICS.items():
+        histogram = merged.get(metric, {})
+        values = histogram_percentiles(histogram, cohortPercentiles)
+        rows.append(html.Tr([html.Td(info['label']), html.Td(sum(histogram.values()))] +
+                            [html.Td(f"{values[p]:g}" if p in values else "-") for p in cohortPercentiles]))
+    table = dbc.Table([header, html.Tbody(rows)], bordered=True, striped=True, size="sm")
     
-    # Update layout
-    fig.update_layout(
-        plot_bgcolor='rgba(0,0,0,0)',
-        paper_bgcolor='rgba(0,0,0,0)',
-        yaxis=dict(title='Sleep Hours', range=[0, 10]),
-        yaxis2=dict(title='Sleep Score', range=[0, 100], overlaying='y', side='right'),
-        hovermode='x unified',
-        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1)
-    )
+    # Distribution histograms
+    figures = []
+    for metric, info in COHORT_METRICS.items():
+        histogram = merged.get(metric, {})
+        if not histogram:
+            fig = px.bar(title="No entries in this range")
+        else:
+            fig = px.bar(
+                x=list(histogram.keys()),
+                y=list(histogram.values()),
+                labels={'x': info['label'], 'y': 'Entries'},
+                title=f"{info['label']} Across All Users"
+            )
+        fig.update_layout(plot_bgcolor='rgba(0,0,0,0)', paper_bgcolor='rgba(0,0,0,0)')
+        figures.append(fig)
     
-    # Update traces to use different y-axes
-    fig.data[1].update(yaxis='y2')
+    # Per-day percentile bands of sleep score
+    band_rows = []
+    for day, histograms in sorted(daily.items()):
+        values = histogram_percentiles(histograms.get('sleep_score', {}), [10, 50, 90])
+        if values:
+            band_rows.append({'date': day, 'P10': values[10], 'Median': values[50], 'P90': values[90]})
+    if band_rows:
+        bands = px.line(
+            pd.DataFrame(band_rows),
+            x='date',
+            y=['P10', 'Median', 'P90'],
+            title="Daily Sleep Score Percentiles",
+            labels={'value': 'Sleep Score', 'date': 'Date', 'variable': 'Percentile'}
+        )
+        bands.update_layout(yaxis_range=[0, 100])
+    else:
+        bands = px.line(title="No entries in this range")
+    bands.update_layout(plot_bgcolor='rgba(0,0,0,0)', paper_bgcolor='rgba(0,0,0,0)',
+                        hovermode='x unified')
     
-    return fig
+    return table, figures[0], figures[1], bands
+
+# =============================================
+# RESPONSE COMPRESSION & PAYLOAD REPORT
+# =============================================
+COMPRESSIBLE_PATHS = ('/_dash-update-component', '/_dash-layout', '/_dash-dependencies',
+                      '/_dash-component-suites/', '/assets/')
+STATIC_PATHS = ('/_dash-component-suites/', '/assets/')
+COMPRESSIBLE_TYPES = ('application/json', 'application/javascript', 'text/')
+
+# Compressed static bodies, keyed by (path, ETag, encoding). The query string
+# is left out (it only busts browser caches), so clients cannot add entries
+# by varying it; edited files still leave old ETags behind, hence the LRU bound.
+static_compression_cache = OrderedDict()
+static_compression_lock = threading.Lock()
+
+# Bytes sent per callback output: {output: {'calls', 'raw_bytes', 'wire_bytes', 'max_raw_bytes'}}
+payload_stats = {}
+payload_stats_lock = threading.Lock()
+
+def choose_encoding(accept_encoding):
+    if brotli is not None and 'br' in accept_encoding:
+        return 'br'
+    if 'gzip' in accept_encoding:
+        return 'gzip'
+    return None
+
+def compress_body(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=compressLevel)
+    return gzip.compress(body, compresslevel=compressLevel)
+
+def record_payload_size(output, raw_bytes, wire_bytes):
+    with payload_stats_lock:
+        stats = payload_stats.setdefault(output, {
+            'calls': 0, 'raw_bytes': 0, 'wire_bytes': 0, 'max_raw_bytes': 0
+        })
+        stats['calls'] += 1
+        stats['raw_bytes'] += raw_bytes
+        stats['wire_bytes'] += wire_bytes
+        stats['max_raw_bytes'] = max(stats['max_raw_bytes'], raw_bytes)
+
+def payload_report():
+    """Per-callback payload sizes, largest average response first"""
+    with payload_stats_lock:
+        rows = []
+        for output, stats in payload_stats.items():
+            rows.append(dict(stats, output=output,
+                             avg_raw_bytes=stats['raw_bytes'] // stats['calls'],
+                             avg_wire_bytes=stats['wire_bytes'] // stats['calls']))
+    return sorted(rows, key=lambda row: row['avg_raw_bytes'], reverse=True)
+
+@server.after_request
+def compress_response(response):
+    path = flask.request.path
+    if not path.startswith(COMPRESSIBLE_PATHS):
+        return response
+    
+    is_static = path.startswith(STATIC_PATHS)
+    # Only fingerprinted files are immutable; the rest keep Dash's ETag revalidation
+    fingerprinted = is_static and check_fingerprint(path)[1]
+    if fingerprinted and response.status_code == 200:
+        response.headers['Cache-Control'] = f"public, max-age={staticCacheSeconds}, immutable"
+    
+    compressible = (response.status_code == 200
+                    and 'Content-Encoding' not in response.headers
+                    and (response.mimetype or '').startswith(COMPRESSIBLE_TYPES))
+    if compressible:
+        response.direct_passthrough = False
+        body = response.get_data()
+    else:
+        body = None
+    
+    encoding = choose_encoding(flask.request.headers.get('Accept-Encoding', ''))
+    wire_body = body
+    if body is not None and encoding and len(body) >= compressMinBytes:
+        etag, _ = response.get_etag()
+        # Unfingerprinted files can change in place, so their bodies are cached per ETag
+        cacheable = is_static and (fingerprinted or etag)
+        cache_key = (path, etag, encoding)
+        wire_body = None
+        if cacheable:
+            with static_compression_lock:
+                wire_body = static_compression_cache.get(cache_key)
+                if wire_body is not None:
+                    static_compression_cache.move_to_end(cache_key)
+        if wire_body is None:
+            wire_body = compress_body(body, encoding)
+            if cacheable:
+                with static_compression_lock:
+                    static_compression_cache[cache_key] = wire_body
+                    while len(static_compression_cache) > compressCacheEntries:
+                        static_compression_cache.popitem(last=False)
+        response.set_data(wire_body)
+        response.headers['Content-Encoding'] = encoding
+        response.headers['Vary'] = 'Accept-Encoding'
+        
+        if etag:
+            # Each encoding is its own representation with its own validator;
+            # the handler only knew the uncompressed one, so answer 304s here
+            response.set_etag(f"{etag}-{encoding}")
+            if flask.request.if_none_match.contains(f"{etag}-{encoding}"):
+                return flask.Response(status=304, headers={
+                    'ETag': response.headers['ETag'],
+                    'Vary': 'Accept-Encoding',
+                    'Cache-Control': response.headers.get('Cache-Control', 'no-cache')
+                })
+    
+    if path == '/_dash-update-component' and body is not None:
+        request_json = flask.request.get_json(silent=True) or {}
+        record_payload_size(request_json.get('output', 'unknown'), len(body), len(wire_body))
+    return response
+
+@server.route('/_payload-report')
+def payload_report_view():
+    # Local diagnostics only
+    if flask.request.remote_addr not in ('127.0.0.1', '::1'):
+        flask.abort(403)
+    return flask.jsonify(payload_report())
+
+# =============================================
+# PROFILING
+# =============================================
+class StackSampler(threading.Thread):
+    """Periodically sample one thread's stack into collapsed-stack counts"""
+    def __init__(self, thread_id, interval):
+        super().__init__(name="stack-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+    
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+    
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+def should_profile_request():
+    if profileToken and flask.request.headers.get(profileHeader) == profileToken:
+        return True
+    return (profileSampleRate > 0 and flask.request.path == '/_dash-update-component'
+            and random.random() < profileSampleRate)
+
+def write_profile(name, profiler, sampler):
+    """Save a pstats file and a collapsed-stack file (flamegraph.pl / speedscope input)"""
+    os.makedirs(profileDir, exist_ok=True)
+    base = os.path.join(profileDir, name)
+    profiler.dump_stats(base + ".prof")
+    with open(base + ".collapsed", "w", encoding="utf-8") as collapsed:
+        for stack, count in sampler.stacks.most_common():
+            collapsed.write(f"{stack} {count}\n")
+    return base
+
+def start_request_profile():
+    if not should_profile_request():
+        return
+    flask.g.profile_sampler = StackSampler(threading.get_ident(), profileInterval)
+    flask.g.profile_sampler.start()
+    flask.g.profiler = cProfile.Profile()
+    flask.g.profiler.enable()
+
+def finish_request_profile(exc):
+    profiler = flask.g.pop('profiler', None)
+    if profiler is None:
+        return
+    profiler.disable()
+    sampler = flask.g.pop('profile_sampler')
+    sampler.stop()
+    
+    # Name the capture after the callback output when this was a Dash callback
+    target = flask.request.path
+    if target == '/_dash-update-component':
+        target = (flask.request.get_json(silent=True) or {}).get('output', target)
+    slug = re.sub(r"[^A-Za-z0-9]+", "-", target).strip("-")[:80] or "root"
+    name = f"{datetime.now():%Y%m%d-%H%M%S-%f}-{slug}"
+    try:
+        print(f"✅ Profile written to {write_profile(name, profiler, sampler)}.*")
+    except OSError as err:
+        print(f"❌ Error writing profile: {err}")
+
+# Always installed; a request that is not profiled costs one header lookup
+# and creates no profiler or sampler thread
+server.before_request(start_request_profile)
+server.teardown_request(finish_request_profile)
 
 # =============================================
 # RUN THE APP
 # =============================================
 if __name__ == '__main__':
-    app.run(debug=True, port=8050)
\ No newline at end of file
+    # Only the commands that need the schema touch it; importing the module never does
+    if sys.argv[1:] == ['init-db']:
+        setup_db()
+        sys.exit(0)
+    if sys.argv[1:2] in (['grant-admin'], ['revoke-admin']) and len(sys.argv) == 3:
+        set_user_admin(sys.argv[2], sys.argv[1] == 'grant-admin')
+        sys.exit(0)
+    if sys.argv[1:2] == ['delete-user'] and len(sys.argv) == 3:
+        delete_user(sys.argv[2])
+        sys.exit(0)
+    if sys.argv[1:] == ['migrate']:
+        setup_db()
+        migrate_sleep_records_compact()
+        migrate_conversations_partitioned()
+        backfill_search_index()
+        sys.exit(0)
+    if sys.argv[1:] in (['benchmark'], ['benchmark', '--database']):
+        benchmark_execution_modes(use_database='--database' in sys.argv)
+        sys.exit(0)
+    if sys.argv[1:] == ['maintain-partitions']:
+        run_partition_maintenance()
+        sys.exit(0)
+    if sys.argv[1:] == ['recommend']:
+        run_recommendation_batch()
+        sys.exit(0)
+    if sys.argv[1:2] == ['ingest']:
+        ingest_spool(sys.argv[2] if len(sys.argv) > 2 else None)
+        sys.exit(0)
+    
+    if sessionDir and not sessionSecret:
+        sys.exit("❌ Set SESSION_SECRET when sessionDir is used (e.g. SESSION_SECRET=$(openssl rand -hex 32))")
+    
+    debug = True
+    # The debug reloader runs this block in a watcher process and again in the
+    # serving child; schema setup and background jobs only run in the child
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        if use_async_callbacks:
+            print("⚠️ asyncCallbacks has no concurrency benefit under app.run (WSGI); serve the app with an ASGI server")
+        setup_db()
+        start_partition_maintenance()
+        start_recommendation_scheduler()
+        start_ingest_watcher()
+    app.run(debug=debug, port=8050)
\ No newline at end of file